@@ -1,4 +1,9 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
+import pandas as pd
+import geopandas as gpd
 
 # Given data
 y = [0, 20.13425, 40.2685, 60.40276, 80.53701, 100.6713, 120.8055, 140.9398, 161.074, 181.2083, 201.3425, 221.4768, 241.611, 261.7453, 281.8795, 302.0138, 322.148, 342.2823, 362.4165, 382.5508, 402.685, 422.8193, 442.9535, 463.0878, 483.222, 503.3563, 523.4906, 543.6248, 563.7591, 583.8933, 604.0276, 604.0276]
@@ -53,22 +58,273 @@ def calculate_hydraulic_parameters(water_level):
     return area, wetted_perimeter
     
 
-# Calculate Q-H relation
-lowest_point = min(z)
-max_depth = 10  # meters
-step = 0.1  # 10 cm steps
-
-water_levels = np.arange(lowest_point, lowest_point + max_depth + step, step)
-results = []
-
-for wl in water_levels:
-    A, P = calculate_hydraulic_parameters(wl)
-    R = A / P if P > 0 else 0
-    Q = (1/n) * A * R**(2/3) * S**(1/2)
-    results.append((wl, Q, A, P))
-
-# Print results
-print("Water Level (m) | Discharge (m³/s) | Wetted Area (m²) | Wetted Perimeter (m)")
-print("--------------------------------------------------------------------------")
-for wl, Q, A, P in results:
-    print(f"{wl:.2f} | {Q:.2f} | {A:.2f} | {P:.2f}")
\ No newline at end of file
+def hydraulic_parameters(water_levels, y, z, chunk_size=250_000):
+    """Wetted area and wetted perimeter for many water levels at once.
+
+    NumPy version of calculate_hydraulic_parameters. For every (water level,
+    segment) combination the wet fraction t of the segment is found by
+    broadcasting and clipping; a segment is wet over the part of its length
+    that lies below the water level, so partially wetted segments are exact.
+    With dy the width and zlow/r the lowest point and height range of a segment:
+
+        area      = sum(dy * t * (h - zlow - t * r / 2))
+        perimeter = sum(t * length)
+
+    and the sums over the segments are matrix-vector products. Returns two
+    arrays with the shape of water_levels. chunk_size limits the number of
+    combinations evaluated at once; chunks that fit in the CPU cache are fastest.
+    """
+    water_levels = np.asarray(water_levels, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+
+    dy = np.diff(y)
+    length = np.hypot(dy, np.diff(z))
+    z_low = np.minimum(z[:-1], z[1:])
+    z_range = np.abs(np.diff(z))
+    # a flat segment is dry up to its level and entirely wet above it
+    inv_range = np.divide(1.0, z_range, out=np.full_like(z_range, np.finfo(np.float64).max), where=z_range > 0)
+    dy_z_low = dy * z_low
+    dy_range = 0.5 * dy * z_range
+
+    levels = water_levels.ravel()
+    area = np.empty(levels.shape)
+    perimeter = np.empty(levels.shape)
+    chunk = max(1, chunk_size // max(len(dy), 1))
+    with np.errstate(over='ignore'):
+        for i in range(0, len(levels), chunk):
+            h = levels[i:i + chunk]
+            t = np.subtract.outer(h, z_low)
+            t *= inv_range
+            np.clip(t, 0.0, 1.0, out=t)
+            area[i:i + chunk] = h * (t @ dy) - t @ dy_z_low - (t * t) @ dy_range
+            perimeter[i:i + chunk] = t @ length
+
+    return area.reshape(water_levels.shape), perimeter.reshape(water_levels.shape)
+
+def discharge(area, perimeter, n, S):
+    # Manning's equation, with no discharge where the profile is dry
+    area = np.asarray(area, dtype=np.float64)
+    perimeter = np.asarray(perimeter, dtype=np.float64)
+    R = np.divide(area, perimeter, out=np.zeros_like(area), where=perimeter > 0)
+    return (1/n) * area * R**(2/3) * S**(1/2)
+
+def rating_curve(y, z, n, S, max_depth=10, step=0.1):
+    """Q-H table of one profile from its lowest point up to max_depth, as a dict of arrays."""
+    lowest_point = np.min(z)
+    water_levels = np.arange(lowest_point, lowest_point + max_depth + step / 2, step)
+    A, P = hydraulic_parameters(water_levels, y, z)
+    return {
+        'water_level': water_levels,
+        'depth': water_levels - lowest_point,
+        'discharge': discharge(A, P, n, S),
+        'area': A,
+        'perimeter': P,
+    }
+
+def monotone_inverse(water_level, discharge):
+    """Breakpoints (discharge, water_level) of the lowest water level at which each discharge is reached.
+
+    Where Q dips and rises again, the part below the previous maximum is left
+    out: the level stays at the maximum until the point where Q climbs back
+    above it, which is interpolated and added as a breakpoint. That breakpoint
+    gets the next float above the maximum, so the discharges are strictly increasing.
+    """
+    levels = [water_level[0]]
+    discharges = [discharge[0]]
+    for i in range(1, len(discharge)):
+        peak = discharges[-1]
+        if discharge[i] <= peak:
+            continue
+        if levels[-1] != water_level[i - 1]:
+            # Q was at or below the maximum since the last breakpoint: add the point where it gets back above it
+            q0, q1 = discharge[i - 1], discharge[i]
+            h0, h1 = water_level[i - 1], water_level[i]
+            level = h0 if q0 >= peak else h0 + (peak - q0) / (q1 - q0) * (h1 - h0)
+            levels.append(level)
+            discharges.append(np.nextafter(peak, np.inf))
+        levels.append(water_level[i])
+        discharges.append(discharge[i])
+    return np.array(discharges), np.array(levels)
+
+class RatingCurve:
+    """Precomputed Q-H relation of one profile, for fast lookups on long time series.
+
+    The relation is stored as breakpoint tables of water level and discharge.
+    q_from_h and h_from_q look up any number of values at once by binary search
+    in the tables (np.interp) and linear interpolation between the breakpoints.
+    Levels below the lowest point give no discharge; values above the top of the
+    table give NaN. For h_from_q the discharge is made monotone (in compound
+    profiles Manning's Q can dip just above a floodplain), so every discharge
+    maps to the lowest water level at which it is reached (see monotone_inverse).
+    """
+
+    def __init__(self, water_level, discharge):
+        self.water_level = np.asarray(water_level, dtype=np.float64)
+        self.discharge = np.asarray(discharge, dtype=np.float64)
+        if self.water_level.ndim != 1 or self.water_level.shape != self.discharge.shape or len(self.water_level) < 2:
+            raise ValueError("water_level and discharge must be 1D tables of equal length (at least 2 breakpoints)")
+        if np.any(np.diff(self.water_level) <= 0):
+            raise ValueError("water_level must be strictly increasing")
+
+        self._inverse_discharge, self._inverse_level = monotone_inverse(self.water_level, self.discharge)
+
+        # the input the tables were computed from (from_profile), saved along with them
+        self.profile = None
+
+    @classmethod
+    def from_profile(cls, y, z, n, S, max_depth=10, step=0.01):
+        """Rating curve of a YZ profile, with breakpoints every step meters up to max_depth."""
+        table = rating_curve(y, z, n, S, max_depth, step)
+        curve = cls(table['water_level'], table['discharge'])
+        curve.profile = _profile_key(y, z, n, S, max_depth, step)
+        return curve
+
+    @classmethod
+    def cached(cls, path, y, z, n, S, max_depth=10, step=0.01):
+        """Load the rating curve from path, or compute and save it there when it is missing or belongs to other input."""
+        key = _profile_key(y, z, n, S, max_depth, step)
+        # np.savez adds the extension when it is missing, so check for the file it actually writes
+        if not path.endswith('.npz'):
+            path += '.npz'
+        if os.path.exists(path):
+            curve = cls.load(path)
+            if curve.profile is not None and np.array_equal(curve.profile, key):
+                return curve
+        curve = cls.from_profile(y, z, n, S, max_depth, step)
+        curve.save(path)
+        return curve
+
+    @classmethod
+    def from_table(cls, table, profile_id=None):
+        """Rating curve from a table as written by batch_rating_curves (one profile, or the given profile_id)."""
+        if profile_id is not None:
+            table = table[table['profile_id'] == profile_id]
+        table = table.sort_values('water_level')
+        return cls(table['water_level'].to_numpy(), table['discharge'].to_numpy())
+
+    def q_from_h(self, water_level):
+        """Discharge at the given water level(s)."""
+        return np.interp(water_level, self.water_level, self.discharge, left=0.0, right=np.nan)
+
+    def h_from_q(self, discharge):
+        """Water level at the given discharge(s)."""
+        return np.interp(discharge, self._inverse_discharge, self._inverse_level, left=np.nan, right=np.nan)
+
+    def save(self, path):
+        """Save the breakpoint tables to an .npz file."""
+        tables = {'water_level': self.water_level, 'discharge': self.discharge}
+        if self.profile is not None:
+            tables['profile'] = self.profile
+        np.savez(path, **tables)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as tables:
+            curve = cls(tables['water_level'], tables['discharge'])
+            if 'profile' in tables:
+                curve.profile = tables['profile']
+        return curve
+
+def _profile_key(y, z, n, S, max_depth, step):
+    # all input of a rating curve in one array, to check whether saved tables are still valid
+    return np.concatenate((np.asarray(y, dtype=np.float64), np.asarray(z, dtype=np.float64), [n, S, max_depth, step]))
+
+def read_profiles(path, layer=None, id_column='profile_id', y_column='y', z_column='z', n_column='n', slope_column='S',
+                  default_n=None, default_slope=None):
+    """Read YZ profiles from a CSV or Parquet file or a GeoPackage layer.
+
+    The table is in long format: one row per profile point with the profile id,
+    y and z, and the roughness and slope of the profile in every row (or use
+    default_n / default_slope). A GeoPackage layer may also hold one 3D line per
+    cross-section; y is then the distance along the line and z its z coordinate.
+    Returns a list of (profile_id, y, z, n, S), with the points in file order.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.parquet':
+        table = pd.read_parquet(path)
+    elif extension == '.gpkg':
+        table = gpd.read_file(path, layer=layer)
+        if y_column not in table.columns and table.geometry.has_z.all():
+            table = profile_points_from_lines(table, id_column)
+        table = pd.DataFrame(table.drop(columns='geometry', errors='ignore'))
+    else:
+        table = pd.read_csv(path)
+
+    profiles = []
+    for profile_id, points in table.groupby(id_column, sort=False):
+        n = points[n_column].iloc[0] if n_column in points.columns else default_n
+        S = points[slope_column].iloc[0] if slope_column in points.columns else default_slope
+        if n is None or S is None:
+            raise ValueError(f"No roughness or slope for profile {profile_id}")
+        profiles.append((profile_id, points[y_column].to_numpy(dtype=np.float64), points[z_column].to_numpy(dtype=np.float64), float(n), float(S)))
+    return profiles
+
+def profile_points_from_lines(lines, id_column, y_column='y', z_column='z'):
+    # one row per vertex of each 3D cross-section line, y measured along the line
+    rows = []
+    for _, line in lines.iterrows():
+        coords = np.asarray(line.geometry.coords)
+        y = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(coords[:, 0]), np.diff(coords[:, 1])))))
+        attributes = line.drop(labels='geometry').to_dict()
+        for y_value, z_value in zip(y, coords[:, 2]):
+            rows.append({**attributes, y_column: y_value, z_column: z_value})
+    return pd.DataFrame(rows)
+
+def _rating_curves(profiles, max_depth, step):
+    # Q-H tables of a batch of profiles, stacked in one table (runs in a worker process)
+    tables = []
+    for profile_id, y, z, n, S in profiles:
+        table = pd.DataFrame(rating_curve(y, z, n, S, max_depth, step))
+        table.insert(0, 'profile_id', profile_id)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+def batch_rating_curves(profiles_path, output_path, layer=None, max_depth=10, step=0.1, workers=None, batch_size=500, **columns):
+    """Q-H tables of all profiles in profiles_path, written to one Parquet (or CSV) file.
+
+    The profiles are divided into batches of batch_size that are computed in
+    parallel worker processes. Extra keyword arguments go to read_profiles.
+    The output has one row per profile and water level.
+    """
+    profiles = read_profiles(profiles_path, layer, **columns)
+    print(f"Computing rating curves for {len(profiles)} profiles...")
+    batches = [profiles[i:i + batch_size] for i in range(0, len(profiles), batch_size)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tables = list(executor.map(_rating_curves, batches, repeat(max_depth), repeat(step)))
+    result = pd.concat(tables, ignore_index=True)
+
+    if output_path.lower().endswith('.parquet'):
+        result.to_parquet(output_path, index=False)
+    else:
+        result.to_csv(output_path, index=False)
+    print(f"Rating curves saved to {output_path}")
+    return result
+
+def main():
+    # Set a file (CSV, Parquet or GeoPackage) with YZ profiles to compute the rating curves of all
+    # profiles in it, instead of the single profile above
+    profiles_path = None
+    profiles_layer = None  # layer name, for a GeoPackage
+    output_path = 'rating_curves.parquet'
+
+    max_depth = 10  # meters
+    step = 0.1  # 10 cm steps
+
+    if profiles_path:
+        batch_rating_curves(profiles_path, output_path, profiles_layer, max_depth, step)
+        return
+
+    # Calculate Q-H relation
+    table = rating_curve(y, z, n, S, max_depth, step)
+    results = zip(table['water_level'], table['discharge'], table['area'], table['perimeter'])
+
+    # Print results
+    print("Water Level (m) | Discharge (m³/s) | Wetted Area (m²) | Wetted Perimeter (m)")
+    print("--------------------------------------------------------------------------")
+    for wl, Q, A, P in results:
+        print(f"{wl:.2f} | {Q:.2f} | {A:.2f} | {P:.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import numpy as np
+
+from qhrelationfromyzprofile import RatingCurve
+
+
+def test_h_from_q_after_dip_in_discharge():
+    # Q dips after h = 2 and only gets back above 10 at h = 4 1/3
+    curve = RatingCurve([0, 1, 2, 3, 4, 5], [0, 5, 10, 8, 9, 12])
+    np.testing.assert_allclose(curve.h_from_q([5, 10, 11, 12]), [1, 2, 4 + 2 / 3, 5])
+    assert np.all(np.diff(curve._inverse_discharge) > 0)
+
+
+def test_h_from_q_after_flat_discharge():
+    curve = RatingCurve([0, 1, 2, 3], [0, 5, 5, 8])
+    np.testing.assert_allclose(curve.h_from_q([5, 6.5]), [1, 2.5])
+
+
+def test_h_from_q_inverts_monotone_curve():
+    curve = RatingCurve([0, 1, 2, 3], [0, 1, 4, 9])
+    levels = np.array([0.5, 1.5, 2.5])
+    np.testing.assert_allclose(curve.h_from_q(curve.q_from_h(levels)), levels)
+
+
+def test_cached_without_npz_extension(tmp_path):
+    path = str(tmp_path / 'curve')
+    y, z = [0, 1, 2, 3], [2, 0, 0, 2]
+    RatingCurve.cached(path, y, z, 0.03, 0.001, max_depth=2)
+    mtime = (tmp_path / 'curve.npz').stat().st_mtime_ns
+    curve = RatingCurve.cached(path, y, z, 0.03, 0.001, max_depth=2)
+    assert (tmp_path / 'curve.npz').stat().st_mtime_ns == mtime
+    assert curve.profile is not None
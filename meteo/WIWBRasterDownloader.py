@@ -1,19 +1,278 @@
 import argparse
+import base64
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 import os
+import re
+import shutil
 import sys
+import tempfile
+import threading
 import time
+import zipfile
+
+# WIWB API endpoints; pass others to WIWBRasterDownloader to use e.g. a local test server
+BASE_URL = "https://wiwb.hydronet.com/api"
+AUTH_URL = "https://login.hydronet.com/auth/realms/hydronet/protocol/openid-connect/token"
+
+# a token is refreshed this many seconds before it expires
+TOKEN_MARGIN = 60
+
+# (connect, read) timeout of every request in seconds, so a stalled transfer or status check is retried
+REQUEST_TIMEOUT = (10, 60)
+
+# size of the pieces in which a ZIP is streamed to disk
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# a timestep the server had no data for is ordered again while it was more recent than this when it was
+# ordered, as the data may still come in; older timesteps without data are not ordered again
+NO_DATA_DELAY = timedelta(days=2)
+
+# timestamp in a raster file name: yyyymmddHHMMSS or yyyymmddHHMM, optionally with a separator after the date
+TIMESTAMP_PATTERN = re.compile(r"(?<!\d)(\d{8})[_T-]?(\d{6}|\d{4})(?!\d)")
+
+
+def split_period(from_date, to_date, chunk=None):
+    """Consecutive (start, end) periods of at most chunk (a timedelta) covering from_date - to_date."""
+    if chunk is None or to_date - from_date <= chunk:
+        return [(from_date, to_date)]
+    periods = []
+    start = from_date
+    while start < to_date:
+        end = min(start + chunk, to_date)
+        periods.append((start, end))
+        start = end
+    return periods
+
+
+def merge_zips(zip_paths, output_zip):
+    # copy the members of all chunk ZIPs into one; a timestep on the boundary of two chunks is kept once
+    names = set()
+    with zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED) as zout:
+        for path in zip_paths:
+            with zipfile.ZipFile(path) as zin:
+                for info in zin.infolist():
+                    if info.filename in names:
+                        continue
+                    names.add(info.filename)
+                    with zin.open(info) as src, zout.open(info.filename, "w") as dst:
+                        shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+
+
+def token_expiry(access_token):
+    # expiry time (epoch seconds) from the exp claim of a JWT access token, None if it has none
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def member_timestamp(name):
+    """Timestamp of a raster from its (ZIP member) file name, None if the name has none."""
+    matches = TIMESTAMP_PATTERN.findall(os.path.basename(name))
+    if not matches:
+        return None
+    date, time_of_day = matches[-1]
+    return datetime.strptime(date + time_of_day.ljust(6, "0"), "%Y%m%d%H%M%S")
+
+
+def timesteps(from_date, to_date, timestep):
+    """All timesteps from from_date up to and including to_date."""
+    steps = []
+    t = from_date
+    while t <= to_date:
+        steps.append(t)
+        t += timestep
+    return steps
+
+
+def contiguous_periods(steps, timestep):
+    # (start, end) of each run of consecutive timesteps
+    periods = []
+    for t in steps:
+        if periods and t - periods[-1][1] == timestep:
+            periods[-1][1] = t
+        else:
+            periods.append([t, t])
+    return [tuple(period) for period in periods]
+
+
+class RasterCache:
+    """Local cache of downloaded rasters, one file per timestep.
+
+    Rasters are kept per data source, variable, extent and timestep length in
+    a folder of cache_dir, with an index.json that maps every timestamp to its
+    file, size and last use. Timesteps that were ordered but not delivered are
+    kept in the index without a file, so they are not ordered again on every
+    run. When the cache grows beyond max_bytes the least recently used rasters
+    are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key_dir(self, data_source, variable, extent, timestep):
+        extent_key = "_".join(f"{value:g}" for value in extent)
+        folder = os.path.join(self.cache_dir, data_source, variable, f"{extent_key}_{int(timestep.total_seconds())}s")
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def read_index(self, key_dir):
+        try:
+            with open(os.path.join(key_dir, "index.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_index(self, key_dir, index):
+        # write to a temporary file first, so an interrupted run does not leave a broken index
+        path = os.path.join(key_dir, "index.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(path + ".tmp", path)
+
+    def missing(self, key_dir, steps):
+        """The timesteps that are not in the cache and were not found to have no data."""
+        index = self.read_index(key_dir)
+        missing = []
+        for t in steps:
+            entry = index.get(t.strftime("%Y%m%d%H%M%S"))
+            if entry is None or (entry["file"] is None and datetime.fromtimestamp(entry["checked"]) - t < NO_DATA_DELAY):
+                missing.append(t)
+        return missing
+
+    def add(self, key_dir, zip_paths, timestep):
+        """Store the rasters in the given ZIPs; returns the number of timesteps added.
+
+        Raises ValueError, before anything is stored, when the rasters in a ZIP
+        are not a whole number of timesteps apart.
+        """
+        for path in zip_paths:
+            with zipfile.ZipFile(path) as zin:
+                stamps = sorted(filter(None, (member_timestamp(info.filename) for info in zin.infolist())))
+            for previous, t in zip(stamps, stamps[1:]):
+                if (t - previous) % timestep:
+                    raise ValueError(f"Rasters in {path} are {t - previous} apart, which does not fit the "
+                                     f"cache timestep of {timestep}; pass the timestep of the data source (--timestep_minutes)")
+
+        index = self.read_index(key_dir)
+        added = 0
+        now = time.time()
+        for path in zip_paths:
+            with zipfile.ZipFile(path) as zin:
+                for info in zin.infolist():
+                    timestamp = member_timestamp(info.filename)
+                    if timestamp is None or info.is_dir():
+                        continue
+                    key = timestamp.strftime("%Y%m%d%H%M%S")
+                    if key in index and index[key]["file"] is not None:
+                        continue
+                    name = os.path.basename(info.filename)
+                    with zin.open(info) as src, open(os.path.join(key_dir, name), "wb") as dst:
+                        shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+                    index[key] = {"file": name, "size": info.file_size, "used": now}
+                    added += 1
+        self.write_index(key_dir, index)
+        return added
+
+    def mark_no_data(self, key_dir, steps):
+        """Record the given (ordered) timesteps that are still not cached as having no data; returns their number."""
+        index = self.read_index(key_dir)
+        now = time.time()
+        no_data = 0
+        for t in steps:
+            key = t.strftime("%Y%m%d%H%M%S")
+            if key not in index or index[key]["file"] is None:
+                index[key] = {"file": None, "size": 0, "used": now, "checked": now}
+                no_data += 1
+        self.write_index(key_dir, index)
+        return no_data
+
+    def export(self, key_dir, from_date, to_date, output_zip):
+        """Write all cached rasters from from_date up to and including to_date to output_zip; returns the number written."""
+        index = self.read_index(key_dir)
+        first, last = from_date.strftime("%Y%m%d%H%M%S"), to_date.strftime("%Y%m%d%H%M%S")
+        now = time.time()
+        written = 0
+        with zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED) as zout:
+            for key in sorted(index):
+                entry = index[key]
+                if not first <= key <= last or entry["file"] is None:
+                    continue
+                zout.write(os.path.join(key_dir, entry["file"]), entry["file"])
+                entry["used"] = now
+                written += 1
+        self.write_index(key_dir, index)
+        return written
+
+    def evict(self):
+        """Remove the least recently used rasters until the cache is within max_bytes."""
+        entries = []
+        indexes = {}
+        for folder, _, files in os.walk(self.cache_dir):
+            if "index.json" in files:
+                indexes[folder] = self.read_index(folder)
+                entries.extend((entry["used"], folder, key, entry["size"]) for key, entry in indexes[folder].items())
+        total = sum(entry[3] for entry in entries)
+        if total <= self.max_bytes:
+            return 0
+
+        removed = 0
+        changed = set()
+        for _, folder, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            entry = indexes[folder].pop(key)
+            if entry["file"] is not None:
+                try:
+                    os.remove(os.path.join(folder, entry["file"]))
+                except FileNotFoundError:
+                    pass
+            total -= size
+            removed += 1
+            changed.add(folder)
+        for folder in changed:
+            self.write_index(folder, indexes[folder])
+        print(f"Removed {removed} rasters from the cache")
+        return removed
+
 
 class WIWBRasterDownloader:
-    def __init__(self, credentials_path):
+    def __init__(self, credentials_path, base_url=BASE_URL, auth_url=AUTH_URL, poll_interval=2, max_poll_interval=60,
+                 poll_backoff=1.5, token_cache_path=None, max_retries=5, timeout=REQUEST_TIMEOUT):
         print("Initializing WIWB Raster Downloader...")
-        self.base_url = "https://wiwb.hydronet.com/api"
-        self.auth_url = "https://login.hydronet.com/auth/realms/hydronet/protocol/openid-connect/token"
+        self.base_url = base_url
+        self.auth_url = auth_url
+        # status polling: first check after poll_interval seconds, growing by poll_backoff up to max_poll_interval
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_backoff = poll_backoff
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        # one session for all requests, with a connection pool large enough for the download threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
         self.client_id, self.client_secret = self.get_credentials(credentials_path)
         print("Credentials loaded successfully.")
-        self.access_token = self.get_access_token()
+
+        # the access token is reused until shortly before it expires, also across runs with a token cache file
+        self.token_cache_path = token_cache_path
+        self.token_expires = 0
+        self._token_lock = threading.Lock()
+        self.access_token = self.read_token_cache() if token_cache_path else None
+        if self.access_token is None:
+            self.access_token = self.get_access_token()
 
     def get_credentials(self, path):
         print(f"Attempting to read credentials from: {path}")
@@ -37,16 +296,146 @@ class WIWBRasterDownloader:
             "client_id": self.client_id,
             "client_secret": self.client_secret
         }
-        response = requests.post(self.auth_url, data=data)
+        response = self.session.post(self.auth_url, data=data, timeout=self.timeout)
         response.raise_for_status()
+        token = response.json()
         print("Access token obtained successfully.")
-        return response.json()["access_token"]
+        if "expires_in" in token:
+            self.token_expires = time.time() + float(token["expires_in"])
+        else:
+            self.token_expires = token_expiry(token["access_token"]) or time.time() + 300
+        if self.token_cache_path:
+            with open(self.token_cache_path, "w") as f:
+                json.dump({"access_token": token["access_token"], "expires_at": self.token_expires}, f)
+        return token["access_token"]
+
+    def read_token_cache(self):
+        # cached token, if it is still valid for a while
+        try:
+            with open(self.token_cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        access_token = cache.get("access_token")
+        expires = cache.get("expires_at") or (token_expiry(access_token) if access_token else None)
+        if not access_token or not expires or expires - TOKEN_MARGIN < time.time():
+            return None
+        print("Using cached access token.")
+        self.token_expires = expires
+        return access_token
+
+    def refresh_token(self, force=False):
+        with self._token_lock:
+            if force or self.token_expires - TOKEN_MARGIN < time.time():
+                self.access_token = self.get_access_token()
+        return self.access_token
 
-    def download_rasters(self, data_source, variable, x_min, y_min, x_max, y_max, from_date, to_date, output_zip):
+    def request(self, method, url, **kwargs):
+        # request through the session with a valid token; on 401 the token is renewed and the request retried once
+        extra_headers = kwargs.pop("headers", {})
+        kwargs.setdefault("timeout", self.timeout)
+        token = self.refresh_token()
+        response = self.session.request(method, url, headers={**self.headers(), **extra_headers}, **kwargs)
+        if response.status_code == 401:
+            response.close()
+            # another thread may have renewed the token in the meantime
+            self.refresh_token(force=self.access_token == token)
+            response = self.session.request(method, url, headers={**self.headers(), **extra_headers}, **kwargs)
+        return response
+
+    def download_rasters(self, data_source, variable, x_min, y_min, x_max, y_max, from_date, to_date, output_zip,
+                         chunk_days=None, workers=4, cache=None, timestep=timedelta(hours=1)):
+        """Order and download the rasters for a period into output_zip.
+
+        With chunk_days the period is split into chunks of that many days that
+        are ordered at the same time (at most workers at once). Each chunk is
+        polled with a growing interval and downloaded as soon as it is finished;
+        the chunk ZIPs are merged into output_zip at the end.
+
+        With a RasterCache only the timesteps (of length timestep) that are not
+        in the cache yet are ordered; output_zip is then assembled from the cache.
+        """
         print(f"Preparing to download rasters from {from_date} to {to_date}")
+        extent = (x_min, y_min, x_max, y_max)
+        if cache is not None:
+            self.download_rasters_cached(cache, data_source, variable, extent, from_date, to_date, output_zip,
+                                         chunk_days, workers, timestep)
+            return
+
+        chunks = split_period(from_date, to_date, timedelta(days=chunk_days) if chunk_days else None)
+        if len(chunks) == 1:
+            self.download_chunk(data_source, variable, extent, from_date, to_date, output_zip)
+            print(f"Downloaded data saved to {output_zip}")
+            return
+
+        chunk_dir = tempfile.mkdtemp(prefix="wiwb_", dir=os.path.dirname(os.path.abspath(output_zip)))
+        try:
+            chunk_zips = self.download_periods(data_source, variable, extent, chunks, chunk_dir, workers)
+            print(f"Merging {len(chunk_zips)} chunks into {output_zip}...")
+            merge_zips(chunk_zips, output_zip)
+        finally:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+
+        print(f"Downloaded data saved to {output_zip}")
+
+    def download_rasters_cached(self, cache, data_source, variable, extent, from_date, to_date, output_zip,
+                                chunk_days=None, workers=4, timestep=timedelta(hours=1)):
+        key_dir = cache.key_dir(data_source, variable, extent, timestep)
+        steps = timesteps(from_date, to_date, timestep)
+        missing = cache.missing(key_dir, steps)
+
+        if missing:
+            chunk = timedelta(days=chunk_days) if chunk_days else None
+            periods = [chunk_period for start, end in contiguous_periods(missing, timestep)
+                       for chunk_period in split_period(start, end, chunk)]
+            print(f"{len(steps) - len(missing)} of {len(steps)} timesteps found in the cache, "
+                  f"ordering the other {len(missing)} in {len(periods)} requests")
+            chunk_dir = tempfile.mkdtemp(prefix="wiwb_", dir=cache.cache_dir)
+            try:
+                chunk_zips = self.download_periods(data_source, variable, extent, periods, chunk_dir, workers)
+                cache.add(key_dir, chunk_zips, timestep)
+            finally:
+                shutil.rmtree(chunk_dir, ignore_errors=True)
+            no_data = cache.mark_no_data(key_dir, missing)
+            if no_data:
+                print(f"Warning: no data for {no_data} of {len(steps)} timesteps")
+        else:
+            print(f"All {len(steps)} timesteps found in the cache")
+
+        written = cache.export(key_dir, from_date, to_date, output_zip)
+        print(f"{written} rasters written")
+        cache.evict()
+        print(f"Downloaded data saved to {output_zip}")
+
+    def download_periods(self, data_source, variable, extent, periods, chunk_dir, workers=4):
+        """Order and download each (start, end) period to a ZIP in chunk_dir, at most workers at once.
+
+        Returns the ZIP paths in the order of periods.
+        """
+        if len(periods) > 1:
+            print(f"Splitting the request into {len(periods)} chunks")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self.download_chunk, data_source, variable, extent, start, end,
+                                os.path.join(chunk_dir, f"chunk_{i:04d}.zip")): i
+                for i, (start, end) in enumerate(periods)
+            }
+            chunk_zips = [None] * len(periods)
+            for future in as_completed(futures):
+                chunk_zips[futures[future]] = future.result()
+                print(f"Chunk {futures[future] + 1} of {len(periods)} downloaded")
+        return chunk_zips
+
+    def download_chunk(self, data_source, variable, extent, from_date, to_date, output_zip):
+        """Order one period, wait for the export to finish and download it to output_zip."""
+        data_flow_id = self.create_download(data_source, variable, extent, from_date, to_date)
+        self.wait_for_download(data_flow_id)
+        self.fetch_download(data_flow_id, output_zip)
+        return output_zip
+
+    def create_download(self, data_source, variable, extent, from_date, to_date):
+        x_min, y_min, x_max, y_max = extent
         url = f"{self.base_url}/grids/createdownload"
-        headers = {"Authorization": f"Bearer {self.access_token}", "Content-Type": "application/json"}
-        
         request_body = {
             "Readers": [{
                 "DataSourceCode": data_source,
@@ -71,41 +460,76 @@ class WIWBRasterDownloader:
             "DataFlowTypeCode": "Download",
             "DataSourceCode": data_source
         }
-        
-        print("Sending download request...")
-        response = requests.post(url, json=request_body, headers=headers)
+
+        response = self.request("POST", url, json=request_body)
         response.raise_for_status()
         data_flow_id = response.json().get("DataFlowId")
-        print(f"Download request sent. Data flow ID: {data_flow_id}")
-        
-        print("Waiting for download to complete...")
+        print(f"Download request sent for {from_date} to {to_date}. Data flow ID: {data_flow_id}")
+        return data_flow_id
+
+    def wait_for_download(self, data_flow_id):
+        # poll often at first, then less and less often for exports that take long
+        interval = self.poll_interval
+        failures = 0
         while True:
-            status = self.check_download_status(data_flow_id)
-            print(f"Current status: {status}")
+            try:
+                status = self.check_download_status(data_flow_id)
+                failures = 0
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # a status check that stalls or drops is repeated, up to max_retries times in a row
+                failures += 1
+                if failures > self.max_retries:
+                    raise
+                status = f"status check failed ({e})"
             if status == "Finished":
-                break
+                return
             elif status == "Failed":
-                raise Exception("Download failed")
-            time.sleep(10)  # Wait for 10 seconds before checking again
+                raise Exception(f"Download failed (data flow ID {data_flow_id})")
+            print(f"Data flow {data_flow_id}: {status}, checking again in {interval:g} s")
+            time.sleep(interval)
+            interval = min(interval * self.poll_backoff, self.max_poll_interval)
 
-        print("Download process completed. Retrieving file...")
+    def fetch_download(self, data_flow_id, output_zip):
+        """Stream the export to output_zip; an interrupted transfer is resumed with a Range request."""
         download_url = f"{self.base_url}/grids/downloadfile?dataflowid={data_flow_id}"
-        response = requests.get(download_url, headers=headers)
-        response.raise_for_status()
+        part_path = output_zip + ".part"
+        if os.path.exists(part_path):
+            os.remove(part_path)
 
         print(f"Writing data to {output_zip}...")
-        with open(output_zip, "wb") as f:
-            f.write(response.content)
+        for attempt in range(self.max_retries + 1):
+            received = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {"Range": f"bytes={received}-"} if received else {}
+            try:
+                with self.request("GET", download_url, headers=headers, stream=True) as response:
+                    if response.status_code == 416:
+                        # nothing left to send: the previous attempt got the whole file
+                        break
+                    response.raise_for_status()
+                    # 206: the server resumes at the requested offset; 200: it sends the whole file again
+                    mode = "ab" if response.status_code == 206 else "wb"
+                    with open(part_path, mode) as f:
+                        for block in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            f.write(block)
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = min(2 ** attempt, 30)
+                print(f"Download of data flow {data_flow_id} interrupted ({e}), resuming in {wait} s")
+                time.sleep(wait)
 
-        print(f"Downloaded data saved to {output_zip}")
+        os.replace(part_path, output_zip)
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.access_token}", "Content-Type": "application/json"}
 
     def check_download_status(self, data_flow_id):
         url = f"{self.base_url}/entity/dataflows/get"
-        headers = {"Authorization": f"Bearer {self.access_token}", "Content-Type": "application/json"}
         request_body = {
             "DataFlowIds": [data_flow_id]
         }
-        response = requests.post(url, json=request_body, headers=headers)
+        response = self.request("POST", url, json=request_body)
         response.raise_for_status()
         return response.json()["DataFlows"][str(data_flow_id)]["State"]
 
@@ -120,6 +544,14 @@ def main():
     parser.add_argument("results_zip", type=str, help="Output ZIP file name")
     parser.add_argument("--data_source", type=str, default="Knmi.Radar.Uncorrected", help="Data source code")
     parser.add_argument("--variable", type=str, default="P", help="Variable code")
+    parser.add_argument("--chunk_days", type=int, default=None, help="Split the period into concurrent orders of this many days")
+    parser.add_argument("--workers", type=int, default=4, help="Maximum number of concurrent orders")
+    parser.add_argument("--base_url", type=str, default=BASE_URL, help="WIWB API URL")
+    parser.add_argument("--auth_url", type=str, default=AUTH_URL, help="Token endpoint URL")
+    parser.add_argument("--token_cache", type=str, default=None, help="JSON file to keep the access token in between runs")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Folder of a local raster cache; only missing timesteps are ordered")
+    parser.add_argument("--cache_max_gb", type=float, default=10, help="Maximum size of the raster cache (GB)")
+    parser.add_argument("--timestep_minutes", type=int, default=60, help="Timestep of the data source, for the raster cache")
     
     debug_path = r"c:\GITHUB\Meteobase\backend\licenses\credentials.txt"
     release_path = os.path.join(os.path.dirname(sys.executable), "licenses", "credentials.txt")
@@ -133,7 +565,10 @@ def main():
 
     try:
         print("Starting WIWB Raster Downloader...")
-        downloader = WIWBRasterDownloader(args.credentials)
+        downloader = WIWBRasterDownloader(args.credentials, args.base_url, args.auth_url,
+                                          token_cache_path=args.token_cache)
+
+        cache = RasterCache(args.cache_dir, int(args.cache_max_gb * 2 ** 30)) if args.cache_dir else None
 
         from_date = datetime.strptime(args.from_date, "%Y%m%d")
         to_date = datetime.strptime(args.to_date, "%Y%m%d")
@@ -152,7 +587,11 @@ def main():
             args.y_max,
             from_date,
             to_date,
-            args.results_zip
+            args.results_zip,
+            args.chunk_days,
+            args.workers,
+            cache,
+            timedelta(minutes=args.timestep_minutes)
         )
         print("Download process completed successfully.")
     except Exception as e:
@@ -1,8 +1,18 @@
 ﻿import requests
+from requests.adapters import HTTPAdapter
 import os
-import csv
+import gzip
+import io
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 #view stations on the map: https://climatedata.ca/download/#station-download
 
@@ -15,81 +25,347 @@ STATION_MAP = {
     # Add more stations here as needed
 }
 
-def download_data(station_id, year, month):
+# bulk data endpoint; point it to a local server for testing
+BASE_URL = "https://climate.weather.gc.ca/climate_data/bulk_data_e.html"
+
+# HTTP status codes worth retrying: rate limited or a temporary server problem
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# columns after Date/Time that identify the day; the other columns (except the flags) hold the observations
+ID_COLUMNS = {"Year", "Month", "Day", "Data Quality"}
+
+# column types of the bulk files; flags are text as well, all other columns are numbers
+DATE_COLUMN = "Date/Time"
+TEXT_COLUMNS = {"Station Name", "Climate ID", "Data Quality"}
+INTEGER_COLUMNS = {"Year", "Month", "Day"}
+
+class DownloadError(Exception):
+    """A bulk data request that failed, also after the retries."""
+
+class RateLimiter:
+    """Allows at most requests_per_second requests per host, shared by all threads."""
+
+    def __init__(self, requests_per_second=5):
+        self.interval = 1.0 / requests_per_second
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def create_session(pool_size=8):
+    # one session with a connection pool for all threads, so connections are reused
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_with_retry(session, url, params, rate_limiter=None, retries=4, backoff=1.0, timeout=30):
+    """GET through the rate limiter, retrying connection errors and RETRY_STATUS answers with exponential backoff."""
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait(url)
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+            retry_after = response.headers.get("Retry-After")
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else backoff * 2 ** attempt
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+        # jitter, so threads that failed together do not retry together
+        time.sleep(delay * random.uniform(0.5, 1.5))
+
+def months(start_date, end_date):
+    """(year, month) of every month from start_date up to and including end_date."""
+    periods = []
+    current_date = start_date.replace(day=1)
+    while current_date <= end_date:
+        periods.append((current_date.year, current_date.month))
+        current_date = (current_date + timedelta(days=32)).replace(day=1)
+    return periods
+
+def plan_requests(station_ids, start_date, end_date, timeframe=2, since=None):
+    """(station_id, year, month) of the requests needed to cover start_date - end_date.
+
+    The bulk endpoint returns a whole month of hourly data (timeframe=1), a
+    whole year of daily data (timeframe=2) or the whole record of monthly data
+    (timeframe=3) per call, so one request is planned per station-month,
+    station-year or station. since optionally maps station ids to the first
+    date still needed (incremental update); stations that are up to date get
+    no requests.
+    """
+    since = since or {}
+    jobs = []
+    for station_id in station_ids:
+        first = max(start_date, since.get(station_id, start_date))
+        if first > end_date:
+            continue
+        if timeframe == 1:
+            jobs.extend((station_id, year, month) for year, month in months(first, end_date))
+        elif timeframe == 2:
+            jobs.extend((station_id, year, 1) for year in range(first.year, end_date.year + 1))
+        else:
+            jobs.append((station_id, first.year, 1))
+    return jobs
+
+def observation_columns(columns):
+    # the measured quantities: the columns after the date, without identification and flag columns
+    columns = list(columns)
+    after_date = columns[columns.index(DATE_COLUMN) + 1:]
+    return [column for column in after_date if column not in ID_COLUMNS and not column.endswith("Flag")]
+
+def typed_columns(data):
+    """Give the columns of a bulk file their types: dates, integers, text (incl. flags) and floats."""
+    data = data.copy()
+    for column in data.columns:
+        if column == DATE_COLUMN:
+            data[column] = pd.to_datetime(data[column])
+        elif column in INTEGER_COLUMNS:
+            data[column] = pd.to_numeric(data[column], errors='coerce').astype("Int16")
+        elif column in TEXT_COLUMNS or column.endswith("Flag"):
+            data[column] = data[column].astype("string")
+        else:
+            data[column] = pd.to_numeric(data[column], errors='coerce').astype("float64")
+    return data
+
+def parse_bulk_csv(content):
+    """Parse the CSV of a bulk data response in memory into a typed DataFrame."""
+    data = pd.read_csv(io.BytesIO(content), encoding='utf-8-sig', dtype=str, keep_default_na=False, na_values=[""])
+    return typed_columns(data)
+
+def read_output(output_file, columns=None, chunksize=100_000):
+    # iterate over a station file (Parquet or CSV) in typed pieces
+    if output_file.endswith(".parquet"):
+        for batch in pq.ParquetFile(output_file).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(output_file, dtype=str, usecols=columns, chunksize=chunksize, encoding='utf-8-sig',
+                                 keep_default_na=False, na_values=[""]):
+            yield typed_columns(chunk)
+
+def output_columns(output_file):
+    if output_file.endswith(".parquet"):
+        return pq.read_schema(output_file).names
+    return pd.read_csv(output_file, nrows=0, encoding='utf-8-sig').columns.tolist()
+
+def last_data_date(output_file):
+    """Last day with an observation in a station file, None if there is no such file or day.
+
+    The bulk files contain rows for the whole year, also for days that have no
+    data yet; those rows are not counted.
+    """
+    if not os.path.exists(output_file):
+        return None
+    columns = [DATE_COLUMN] + observation_columns(output_columns(output_file))
+    last = None
+    for data in read_output(output_file, columns):
+        observed = data[columns[1:]].notna().any(axis=1)
+        if observed.any():
+            latest = data.loc[observed, DATE_COLUMN].max()
+            last = latest if last is None else max(last, latest)
+    return None if last is None else last.to_pydatetime()
+
+class StationWriter:
+    """Appends the rows of one station to a Parquet file (.parquet) or a CSV (.csv or .csv.gz).
+
+    Rows are deduplicated on their date, so a day that was already written is
+    skipped; only the set of written dates is kept in memory, not the rows.
+    With since (incremental update) the rows of the existing file before that
+    date are copied, and only rows from that date on are taken from new data.
+    The file is written next to output_file and replaces it on close(), unless
+    one of the downloads of the station failed (see failed).
+    """
+
+    def __init__(self, output_file, since=None):
+        self.output_file = output_file
+        self.since = pd.Timestamp(since) if since is not None else None
+        folder, name = os.path.split(output_file)
+        self.partial_file = os.path.join(folder, f"partial_{name}")
+        self.dates = set()
+        self.rows = 0
+        self.failed = []  # (year, month) of the downloads of this station that failed
+        self._writer = None
+        self._file = None
+        if self.since is not None and os.path.exists(output_file):
+            for data in read_output(output_file):
+                self._append(data[data[DATE_COLUMN] < self.since])
+
+    def write(self, data):
+        if self.since is not None:
+            data = data[data[DATE_COLUMN] >= self.since]
+        self._append(data)
+
+    def _append(self, data):
+        dates = data[DATE_COLUMN]
+        new = ~dates.duplicated() & ~dates.isin(self.dates)
+        data = data[new]
+        if data.empty:
+            return
+        self.dates.update(data[DATE_COLUMN])
+        self.rows += len(data)
+
+        if self.output_file.endswith(".parquet"):
+            if self._writer is None:
+                table = pa.Table.from_pandas(data, preserve_index=False)
+                self._writer = pq.ParquetWriter(self.partial_file, table.schema, compression='zstd')
+            else:
+                table = pa.Table.from_pandas(data, schema=self._writer.schema, preserve_index=False)
+            self._writer.write_table(table)
+        else:
+            header = self._file is None
+            if header:
+                opener = gzip.open if self.output_file.endswith(".gz") else open
+                self._file = opener(self.partial_file, 'wt', newline='', encoding='utf-8')
+            data.to_csv(self._file, header=header, index=False, date_format="%Y-%m-%d")
+
+    def close(self, keep=True):
+        """Finish the file.
+
+        The existing output_file is left as it was with keep=False (after an
+        error) or when a download of the station failed, so a later
+        (incremental) run still fetches the missing period.
+        """
+        if self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+        if keep and self.rows and not self.failed:
+            os.replace(self.partial_file, self.output_file)
+            print(f"Combined data saved to {self.output_file} ({self.rows} days)")
+        else:
+            if self.failed:
+                print(f"{self.output_file} not updated: {len(self.failed)} downloads failed")
+            if os.path.exists(self.partial_file):
+                os.remove(self.partial_file)
+
+def download_data(station_id, year, month, session=None, base_url=BASE_URL, rate_limiter=None, timeframe=2):
+    """Download one bulk data file and parse it in memory.
+
+    Returns a typed DataFrame, or None when the station has no data for the
+    period. Raises DownloadError when the request fails.
+    """
     station_name = STATION_MAP.get(station_id, f"Unknown_{station_id}")
-    url = f"https://climate.weather.gc.ca/climate_data/bulk_data_e.html?format=csv&stationID={station_id}&Year={year}&Month={month}&Day=1&time=&timeframe=2&submit=Download+Data"
+    params = {
+        "format": "csv",
+        "stationID": station_id,
+        "Year": year,
+        "Month": month,
+        "Day": 1,
+        "time": "",
+        "timeframe": timeframe,
+        "submit": "Download Data",
+    }
     
     try:
-        response = requests.get(url, timeout=10)
+        response = get_with_retry(session or requests, base_url, params, rate_limiter)
         
         if response.status_code == 200:
-            if "Date/Time" in response.text:
-                filename = f"temp_{year}_{month:02d}_{station_name}.csv"
-                with open(filename, 'wb') as file:
-                    file.write(response.content)
-                print(f"Downloaded: {filename}")
-                return filename
+            if b"Date/Time" in response.content:
+                data = parse_bulk_csv(response.content)
+                print(f"Downloaded: {station_name} (ID: {station_id}), {year}-{month:02d}, {len(data)} rows")
+                return data
             else:
                 print(f"No data available for {station_name} (ID: {station_id}), {year}-{month:02d}")
         else:
-            print(f"Failed to download data for {station_name} (ID: {station_id}), {year}-{month:02d}. Status code: {response.status_code}")
+            raise DownloadError(f"Failed to download data for {station_name} (ID: {station_id}), {year}-{month:02d}. Status code: {response.status_code}")
     
     except requests.exceptions.RequestException as e:
-        print(f"Error downloading data for {station_name} (ID: {station_id}), {year}-{month:02d}: {e}")
+        raise DownloadError(f"Error downloading data for {station_name} (ID: {station_id}), {year}-{month:02d}: {e}") from e
     
     return None
 
-def combine_csv_files(files, output_file, remove_temporary_files):
-    combined_data = []
-    headers = None
-    data_set = set()  # To keep track of unique rows
-
-    for file in files:
-        with open(file, 'r') as csvfile:
-            reader = csv.reader(csvfile)
-            current_headers = next(reader)
-            
-            if headers is None:
-                headers = current_headers
-                combined_data.append(headers)
-            
-            for row in reader:
-                row_tuple = tuple(row)
-                if row_tuple not in data_set:
-                    data_set.add(row_tuple)
-                    combined_data.append(row)
-        
-        if remove_temporary_files:
-            os.remove(file)  # Remove the temporary file after combining
+def download_stations(jobs, workers=8, base_url=BASE_URL, requests_per_second=5, timeframe=2, failed=None):
+    """Download all (station_id, year, month) jobs concurrently with a bounded thread pool.
+
+    Plan the jobs with plan_requests. All requests share one session and a
+    per-host rate limit. Yields (station_id, DataFrame) in job order; at most
+    2 * workers responses are downloaded ahead of the one being consumed.
+    Jobs that fail are reported and appended to the list failed, if given.
+    """
+    session = create_session(workers)
+    rate_limiter = RateLimiter(requests_per_second)
+    print(f"Downloading {len(jobs)} files with {workers} threads...")
 
-    with open(output_file, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerows(combined_data)
+    def download(job):
+        return download_data(*job, session=session, base_url=base_url, rate_limiter=rate_limiter, timeframe=timeframe)
 
-    print(f"Combined data saved to {output_file}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        remaining = iter(jobs)
+        while True:
+            for job in remaining:
+                pending.append((job, executor.submit(download, job)))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            job, future = pending.popleft()
+            try:
+                data = future.result()
+            except DownloadError as e:
+                print(e)
+                if failed is not None:
+                    failed.append(job)
+                continue
+            if data is not None:
+                yield job[0], data
 
 def main():
     # Configure these variables as needed
     station_ids = list(STATION_MAP.keys())
     start_date = datetime(1967, 1, 1)
     end_date = datetime(2024, 11, 1)
-    
-    for station_id in station_ids:
-        station_files = []
-        current_date = start_date
-        while current_date <= end_date:
-            file = download_data(station_id, current_date.year, current_date.month)
-            if file:
-                station_files.append(file)
-            
-            # Move to the next month
-            current_date += timedelta(days=32)
-            current_date = current_date.replace(day=1)
-        
-        if station_files:
-            station_name = STATION_MAP.get(station_id, f"Unknown_{station_id}")
-            output_file = f"{station_name}_combined_data.csv"
-            combine_csv_files(station_files, output_file, False)
+    workers = 8
+    requests_per_second = 5  # per host, be nice to the server
+
+    # only download the days after the last observation in the existing <station>_combined_data files
+    incremental = True
+
+    # output format per station: '.parquet', '.csv.gz' or '.csv'
+    extension = '.parquet'
+
+    output_files = {station_id: f"{STATION_MAP.get(station_id, f'Unknown_{station_id}')}_combined_data{extension}"
+                    for station_id in station_ids}
+    since = {}
+    if incremental:
+        for station_id, output_file in output_files.items():
+            last_date = last_data_date(output_file)
+            if last_date is not None:
+                since[station_id] = last_date + timedelta(days=1)
+                print(f"{output_file}: data up to {last_date.date()}, updating from {since[station_id].date()}")
+
+    jobs = plan_requests(station_ids, start_date, end_date, since=since)
+    writers = {}
+    failed = []
+    try:
+        for station_id, data in download_stations(jobs, workers, BASE_URL, requests_per_second, failed=failed):
+            if station_id not in writers:
+                writers[station_id] = StationWriter(output_files[station_id], since.get(station_id))
+            writers[station_id].write(data)
+    except BaseException:
+        for writer in writers.values():
+            writer.close(keep=False)
+        raise
+
+    for station_id, year, month in failed:
+        if station_id in writers:
+            writers[station_id].failed.append((year, month))
+    for writer in writers.values():
+        writer.close()
+    if failed:
+        print(f"{len(failed)} downloads failed, the output of these stations was not updated:")
+        for station_id, year, month in failed:
+            print(f"  {STATION_MAP.get(station_id, f'Unknown_{station_id}')} (ID: {station_id}), {year}-{month:02d}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,178 @@
+import io
+import json
+import os
+import threading
+import zipfile
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import WIWBRasterDownloader as wiwb
+from WIWBRasterDownloader import RasterCache, WIWBRasterDownloader
+
+
+class FakeWiwb(BaseHTTPRequestHandler):
+    """Stand-in for the token, createdownload, dataflows/get and downloadfile endpoints.
+
+    An order is finished after polls_until_finished status checks and its ZIP
+    holds one small file per step from StartDate to EndDate, except the
+    timestamps in skip.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        state = self.server.state
+        request = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urlparse(self.path).path
+        if path == "/token":
+            return self.send_json({"access_token": "token", "expires_in": 3600})
+        request = json.loads(request)
+        with state["lock"]:
+            if path == "/api/grids/createdownload":
+                settings = request["Readers"][0]["Settings"]
+                flow_id = len(state["flows"]) + 1
+                state["flows"][flow_id] = {"start": datetime.strptime(settings["StartDate"], "%Y%m%d%H%M%S"),
+                                           "end": datetime.strptime(settings["EndDate"], "%Y%m%d%H%M%S"),
+                                           "polls": 0}
+                return self.send_json({"DataFlowId": flow_id})
+            flow_id = request["DataFlowIds"][0]
+            flow = state["flows"][flow_id]
+            flow["polls"] += 1
+            finished = flow["polls"] > state["polls_until_finished"]
+        self.send_json({"DataFlows": {str(flow_id): {"State": "Finished" if finished else "Running"}}})
+
+    def do_GET(self):
+        state = self.server.state
+        flow = state["flows"][int(parse_qs(urlparse(self.path).query)["dataflowid"][0])]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as zf:
+            t = flow["start"]
+            while t <= flow["end"]:
+                if t not in state["skip"]:
+                    zf.writestr(f"Knmi.Radar.Uncorrected_P_{t:%Y%m%d%H%M%S}.tif", b"raster")
+                t += state["step"]
+        body = buffer.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), FakeWiwb)
+    srv.state = {"lock": threading.Lock(), "flows": {}, "polls_until_finished": 0, "skip": set(),
+                 "step": timedelta(hours=1)}
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def downloader(server, tmp_path):
+    credentials = tmp_path / "credentials.txt"
+    credentials.write_text("client\nsecret\n")
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    return WIWBRasterDownloader(str(credentials), f"{url}/api", f"{url}/token", poll_interval=0.01)
+
+
+def orders(server):
+    # chunks are ordered concurrently, so sort them by period rather than by order id
+    return sorted((flow["start"], flow["end"]) for flow in server.state["flows"].values())
+
+
+def zip_names(path):
+    with zipfile.ZipFile(path) as zf:
+        return zf.namelist()
+
+
+def test_chunks_are_ordered_and_merged(server, downloader, tmp_path):
+    output_zip = str(tmp_path / "rasters.zip")
+    downloader.download_rasters("Knmi.Radar.Uncorrected", "P", 0, 0, 1, 1, datetime(2020, 1, 1),
+                                datetime(2020, 1, 4), output_zip, chunk_days=1, workers=2)
+
+    assert orders(server) == [(datetime(2020, 1, d), datetime(2020, 1, d + 1)) for d in (1, 2, 3)]
+    # the timesteps on the chunk boundaries are kept once
+    names = zip_names(output_zip)
+    assert len(names) == len(set(names)) == 73
+    assert not list(tmp_path.glob("wiwb_*"))
+
+
+def test_status_polling_backs_off(server, downloader, tmp_path, monkeypatch):
+    server.state["polls_until_finished"] = 5
+    sleeps = []
+    monkeypatch.setattr(wiwb.time, "sleep", sleeps.append)
+    downloader.poll_interval, downloader.poll_backoff, downloader.max_poll_interval = 1, 2, 5
+
+    downloader.download_rasters("Knmi.Radar.Uncorrected", "P", 0, 0, 1, 1, datetime(2020, 1, 1),
+                                datetime(2020, 1, 1, 3), str(tmp_path / "rasters.zip"))
+    assert sleeps == [1, 2, 4, 5, 5]
+
+
+def download_cached(downloader, cache, output_zip, from_date, to_date, **kwargs):
+    downloader.download_rasters("Knmi.Radar.Uncorrected", "P", 0, 0, 1, 1, from_date, to_date, str(output_zip),
+                                cache=cache, **kwargs)
+    return zip_names(output_zip)
+
+
+def test_cache_orders_only_missing_timesteps(server, downloader, tmp_path):
+    cache = RasterCache(str(tmp_path / "cache"))
+    assert len(download_cached(downloader, cache, tmp_path / "a.zip", datetime(2020, 1, 2), datetime(2020, 1, 3))) == 25
+
+    names = download_cached(downloader, cache, tmp_path / "b.zip", datetime(2020, 1, 1), datetime(2020, 1, 4))
+    assert orders(server) == [(datetime(2020, 1, 1), datetime(2020, 1, 1, 23)),
+                              (datetime(2020, 1, 2), datetime(2020, 1, 3)),
+                              (datetime(2020, 1, 3, 1), datetime(2020, 1, 4))]
+    assert len(names) == 73
+
+    # fully cached: nothing is ordered
+    assert len(download_cached(downloader, cache, tmp_path / "c.zip", datetime(2020, 1, 2), datetime(2020, 1, 2, 5))) == 6
+    assert len(orders(server)) == 3
+
+
+def test_cache_remembers_timesteps_without_data(server, downloader, tmp_path):
+    server.state["skip"] = {datetime(2020, 1, 1)}
+    cache = RasterCache(str(tmp_path / "cache"))
+    for _ in range(2):
+        names = download_cached(downloader, cache, tmp_path / "a.zip", datetime(2020, 1, 1), datetime(2020, 1, 2))
+        assert len(names) == 24
+    assert len(orders(server)) == 1
+
+
+def test_cache_exports_all_rasters_of_the_period(server, downloader, tmp_path):
+    server.state["step"] = timedelta(minutes=5)
+    cache = RasterCache(str(tmp_path / "cache"))
+    with pytest.raises(ValueError):
+        download_cached(downloader, cache, tmp_path / "a.zip", datetime(2020, 1, 1), datetime(2020, 1, 1, 2))
+
+    names = download_cached(downloader, cache, tmp_path / "a.zip", datetime(2020, 1, 1), datetime(2020, 1, 1, 2),
+                            timestep=timedelta(minutes=5))
+    assert len(names) == 25
+
+
+def test_cache_evicts_least_recently_used(server, downloader, tmp_path):
+    cache = RasterCache(str(tmp_path / "cache"))
+    download_cached(downloader, cache, tmp_path / "a.zip", datetime(2020, 1, 1), datetime(2020, 1, 1, 9))
+    download_cached(downloader, cache, tmp_path / "b.zip", datetime(2020, 1, 2), datetime(2020, 1, 2, 9))
+    # use the first period again, so the second one is the least recently used
+    download_cached(downloader, cache, tmp_path / "a.zip", datetime(2020, 1, 1), datetime(2020, 1, 1, 9))
+
+    cache.max_bytes = 10 * len(b"raster")
+    assert cache.evict() == 10
+    key_dir = cache.key_dir("Knmi.Radar.Uncorrected", "P", (0, 0, 1, 1), timedelta(hours=1))
+    index = cache.read_index(key_dir)
+    assert sorted(index) == [f"202001010{h}0000" for h in range(10)]
+    assert sorted(f for f in os.listdir(key_dir) if f.endswith(".tif")) == sorted(e["file"] for e in index.values())
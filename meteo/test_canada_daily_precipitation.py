@@ -0,0 +1,137 @@
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+
+from canada_daily_precipitation import (DATE_COLUMN, StationWriter, create_session, download_stations,
+                                        get_with_retry, last_data_date, parse_bulk_csv, read_output)
+
+
+def bulk_csv(year, precipitation=1.0, last_observed=None):
+    """A daily bulk file of one year; days after last_observed have no observation yet."""
+    rows = ['"Date/Time","Year","Month","Day","Data Quality","Total Precip (mm)","Total Precip Flag"']
+    day = date(year, 1, 1)
+    while day.year == year:
+        value = "" if last_observed is not None and day > last_observed else f"{precipitation:.1f}"
+        rows.append(f'"{day:%Y-%m-%d}","{year}","{day.month:02d}","{day.day:02d}","","{value}",""')
+        day += timedelta(days=1)
+    return ("\n".join(rows) + "\n").encode("utf-8-sig")
+
+
+class FakeBulkData(BaseHTTPRequestHandler):
+    """Stand-in for the bulk data endpoint.
+
+    status maps a (station_id, year) to a list of status codes to answer
+    before the data (e.g. [503, 503] fails twice); a year in no_data has no
+    data. Every request is recorded with its time.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        state = self.server.state
+        query = {key: value[0] for key, value in parse_qs(urlparse(self.path).query, keep_blank_values=True).items()}
+        station_id, year = int(query["stationID"]), int(query["Year"])
+        with state["lock"]:
+            state["requests"].append((time.monotonic(), station_id, year))
+            codes = state["status"].get((station_id, year), [])
+            code = codes.pop(0) if codes else 200
+        body = b"" if code != 200 else b"no data" if year in state["no_data"] else bulk_csv(year)
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), FakeBulkData)
+    srv.state = {"lock": threading.Lock(), "requests": [], "status": {}, "no_data": set()}
+    srv.url = f"http://127.0.0.1:{srv.server_address[1]}/climate_data/bulk_data_e.html"
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_retry_with_backoff(server):
+    server.state["status"][1, 2000] = [503, 429]
+    response = get_with_retry(create_session(), server.url, {"stationID": 1, "Year": 2000}, backoff=0.01)
+    assert response.status_code == 200
+    assert len(server.state["requests"]) == 3
+
+
+def test_download_stations_in_job_order(server):
+    server.state["status"][1, 2002] = [404]
+    server.state["no_data"].add(2004)
+    jobs = [(station_id, year, 1) for station_id in (1, 2) for year in range(2000, 2005)]
+    failed = []
+    results = list(download_stations(jobs, workers=4, base_url=server.url, requests_per_second=100, failed=failed))
+
+    assert [(station_id, data[DATE_COLUMN].dt.year.iloc[0]) for station_id, data in results] == \
+        [(1, 2000), (1, 2001), (1, 2003), (2, 2000), (2, 2001), (2, 2002), (2, 2003)]
+    assert failed == [(1, 2002, 1)]
+
+
+def test_rate_limit_per_host(server):
+    jobs = [(1, year, 1) for year in range(2000, 2010)]
+    list(download_stations(jobs, workers=8, base_url=server.url, requests_per_second=20))
+    times = sorted(t for t, _, _ in server.state["requests"])
+    # 10 requests at 20 per second are spread over at least 9 intervals of 0.05 s, whatever the number of threads
+    assert len(times) == 10
+    assert times[-1] - times[0] > 0.4
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".csv.gz"])
+def test_station_writer_skips_days_already_written(tmp_path, extension):
+    output_file = str(tmp_path / f"station{extension}")
+    writer = StationWriter(output_file)
+    for year in (2000, 2001, 2000):
+        writer.write(parse_bulk_csv(bulk_csv(year)))
+    writer.close()
+
+    assert not (tmp_path / f"partial_station{extension}").exists()
+    dates = pd.concat(read_output(output_file))[DATE_COLUMN]
+    assert len(dates) == writer.rows == 366 + 365
+    assert dates.is_unique
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".csv"])
+def test_station_writer_incremental_update(tmp_path, extension):
+    output_file = str(tmp_path / f"station{extension}")
+    writer = StationWriter(output_file)
+    writer.write(parse_bulk_csv(bulk_csv(2000, precipitation=1.0, last_observed=date(2000, 6, 30))))
+    writer.close()
+    last = last_data_date(output_file)
+    assert last == datetime(2000, 6, 30)
+
+    writer = StationWriter(output_file, since=last + timedelta(days=1))
+    writer.write(parse_bulk_csv(bulk_csv(2000, precipitation=2.0)))
+    writer.close()
+
+    data = pd.concat(read_output(output_file))
+    precipitation = data.set_index(DATE_COLUMN)["Total Precip (mm)"]
+    assert len(precipitation) == 366
+    assert (precipitation[:"2000-06-30"] == 1.0).all()
+    assert (precipitation["2000-07-01":] == 2.0).all()
+    assert last_data_date(output_file) == datetime(2000, 12, 31)
+
+
+def test_station_writer_keeps_file_when_a_download_failed(tmp_path):
+    output_file = str(tmp_path / "station.csv")
+    writer = StationWriter(output_file)
+    writer.write(parse_bulk_csv(bulk_csv(2000)))
+    writer.close()
+
+    writer = StationWriter(output_file, since=datetime(2001, 1, 1))
+    writer.write(parse_bulk_csv(bulk_csv(2001)))
+    writer.failed.append((2002, 1))
+    writer.close()
+
+    assert last_data_date(output_file) == datetime(2000, 12, 31)
+    assert not (tmp_path / "partial_station.csv").exists()
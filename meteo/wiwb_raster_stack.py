@@ -0,0 +1,132 @@
+"""
+Read the GeoTIFFs of a WIWB results ZIP (see WIWBRasterDownloader.py) into one
+time-indexed array, without extracting them to disk.
+
+Every member is opened as an in-memory dataset (rasterio MemoryFile) and the
+members are decoded in a thread pool; GDAL releases the GIL while decoding.
+The timestamp of each raster is parsed from its member name. The stack can be
+written to a chunked, compressed NetCDF cube.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import zipfile
+import netCDF4
+import numpy as np
+from rasterio.io import MemoryFile
+
+from WIWBRasterDownloader import member_timestamp
+
+CUBE_TIME_UNITS = 'hours since 1970-01-01 00:00:00'
+
+RASTER_EXTENSIONS = ('.tif', '.tiff')
+
+
+def zip_rasters(zf):
+    """(timestamp, member name) of the GeoTIFFs in an open ZipFile, sorted by time."""
+    members = []
+    for name in zf.namelist():
+        if not name.lower().endswith(RASTER_EXTENSIONS):
+            continue
+        timestamp = member_timestamp(name)
+        if timestamp is None:
+            print(f"Skipping {name}: no timestamp in its name")
+            continue
+        members.append((timestamp, name))
+    return sorted(members)
+
+
+def read_member(zf, name):
+    # decode one GeoTIFF straight from the ZIP
+    with MemoryFile(zf.read(name)) as memfile, memfile.open() as src:
+        return src.read(1), {'transform': src.transform, 'crs': src.crs, 'nodata': src.nodata}
+
+
+def read_raster_stack(zip_path, workers=None, nodata_to_nan=True):
+    """Read all GeoTIFFs in zip_path into one (time, rows, cols) array.
+
+    Returns the timestamps, the array and a dict with the transform, crs and
+    nodata value of the rasters. With nodata_to_nan, nodata cells of float
+    rasters become NaN. All rasters must have the same grid.
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        members = zip_rasters(zf)
+        if not members:
+            raise ValueError(f"No GeoTIFFs with a timestamp in their name in {zip_path}")
+        times = [timestamp for timestamp, _ in members]
+
+        first, meta = read_member(zf, members[0][1])
+        stack = np.empty((len(members),) + first.shape, dtype=first.dtype)
+        stack[0] = first
+
+        def decode(i):
+            data, member_meta = read_member(zf, members[i][1])
+            if data.shape != first.shape or member_meta['transform'] != meta['transform']:
+                raise ValueError(f"{members[i][1]} has another grid than {members[0][1]}")
+            stack[i] = data
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() to raise the first error, if any
+            list(executor.map(decode, range(1, len(members))))
+
+    if nodata_to_nan and meta['nodata'] is not None and np.issubdtype(stack.dtype, np.floating):
+        stack[stack == meta['nodata']] = np.nan
+    print(f"Read {len(times)} rasters from {zip_path} ({times[0]} - {times[-1]})")
+    return times, stack, meta
+
+
+def write_stack_netcdf(cube_path, times, stack, meta, variable='precipitation', units='mm', chunk_hours=24):
+    """Write a stack from read_raster_stack to a NetCDF cube, compressed and chunked per chunk_hours timesteps."""
+    _, rows, cols = stack.shape
+    transform = meta['transform']
+    x = transform.c + transform.a * (np.arange(cols) + 0.5)
+    y = transform.f + transform.e * (np.arange(rows) + 0.5)
+
+    with netCDF4.Dataset(cube_path, 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('y', rows)
+        ds.createDimension('x', cols)
+
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = CUBE_TIME_UNITS
+        time.standard_name = 'time'
+        time[:] = netCDF4.date2num(times, CUBE_TIME_UNITS)
+        x_var = ds.createVariable('x', 'f8', ('x',))
+        x_var.units = 'm'
+        x_var.standard_name = 'projection_x_coordinate'
+        x_var[:] = x
+        y_var = ds.createVariable('y', 'f8', ('y',))
+        y_var.units = 'm'
+        y_var.standard_name = 'projection_y_coordinate'
+        y_var[:] = y
+
+        if meta['crs'] is not None:
+            crs = ds.createVariable('crs', 'i4')
+            crs.spatial_ref = meta['crs'].to_wkt()
+            if meta['crs'].to_epsg():
+                crs.epsg_code = f"EPSG:{meta['crs'].to_epsg()}"
+
+        data = ds.createVariable(
+            variable, stack.dtype, ('time', 'y', 'x'), zlib=True, complevel=4, shuffle=True,
+            chunksizes=(min(chunk_hours, len(times)), rows, cols))
+        data.units = units
+        if meta['crs'] is not None:
+            data.grid_mapping = 'crs'
+        data[:] = stack
+
+    print(f"Raster stack saved to {cube_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read a WIWB results ZIP into a time-indexed raster stack")
+    parser.add_argument("results_zip", type=str, help="ZIP file written by WIWBRasterDownloader")
+    parser.add_argument("cube", type=str, help="Output NetCDF file")
+    parser.add_argument("--workers", type=int, default=None, help="Number of decoding threads")
+    args = parser.parse_args()
+
+    times, stack, meta = read_raster_stack(args.results_zip, args.workers)
+    write_stack_netcdf(args.cube, times, stack, meta)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Compare the speed of rasterio's fillnodata (fill_nodata.py) with the
+distance transform based nearest-neighbour fill (fill_nodata_nearest.py)
+on a synthetic flood depth grid with large contiguous gaps.
+"""
+
+import time
+import numpy as np
+from rasterio.fill import fillnodata
+from scipy.ndimage import binary_dilation, gaussian_filter
+
+from fill_nodata_nearest import fill_nearest
+
+
+def synthetic_depth_grid(size, gap_fraction=0.2, gap_radius=25, seed=0):
+    """Smooth depth field with round gaps (0 in the mask) of about gap_radius cells, covering roughly gap_fraction of the grid."""
+    rng = np.random.default_rng(seed)
+    depth = gaussian_filter(rng.random((size, size)), sigma=20).astype(np.float32)
+    seeds = rng.random((size, size)) < gap_fraction / (np.pi * gap_radius ** 2)
+    gaps = binary_dilation(seeds, iterations=gap_radius)
+    mask = np.where(gaps, 0, 255).astype(np.uint8)
+    return depth, mask
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def benchmark(sizes=(500, 1000, 2000), max_search_distance=100, gap_radius=25):
+    print(f"{'size':>6} | {'gaps (%)':>8} | {'fillnodata (s)':>14} | {'nearest (s)':>11} | {'speedup':>7}")
+    for size in sizes:
+        depth, mask = synthetic_depth_grid(size, gap_radius=gap_radius)
+        t_gdal, _ = timed(fillnodata, depth.copy(), mask=mask.copy(), max_search_distance=max_search_distance, smoothing_iterations=0)
+        t_nearest, _ = timed(fill_nearest, depth, mask, max_search_distance)
+        gaps = 100 * (mask == 0).mean()
+        print(f"{size:>6} | {gaps:>8.1f} | {t_gdal:>14.3f} | {t_nearest:>11.3f} | {t_gdal / t_nearest:>7.1f}")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,362 @@
+"""
+Benchmark suite for the scripts in this folder.
+
+Generates synthetic inputs (DTM, channel shapefile, polygon layer, flood
+depth grids, reference grid and hourly NSL_*.ASC precipitation grids) at
+configurable sizes, runs every case in a fresh process and records the
+run time and the peak memory. The results are written as JSON, so runs of
+different versions can be compared with --compare.
+
+Example:
+    python benchmark_rasters.py --sizes 1000 2000 --output results
+    python benchmark_rasters.py --compare results/old.json results/new.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_origin
+from scipy.ndimage import binary_dilation, gaussian_filter
+from shapely.geometry import LineString, Point
+
+EPSG = 28992
+X_ORIGIN = 100000.0
+Y_ORIGIN = 400000.0
+
+
+# --- synthetic fixtures ---
+
+def write_grid(path, data, transform, driver='GTiff', nodata=-9999.0):
+    options = {'tiled': True, 'blockxsize': 256, 'blockysize': 256} if driver == 'GTiff' else {}
+    with rasterio.open(path, 'w', driver=driver, height=data.shape[0], width=data.shape[1], count=1,
+                       dtype=data.dtype, crs=f'EPSG:{EPSG}', transform=transform, nodata=nodata, **options) as dst:
+        dst.write(data, 1)
+
+
+def smooth_field(rng, size, sigma, scale):
+    return (gaussian_filter(rng.random((size, size)), sigma=sigma) - 0.5) * scale
+
+
+def make_dtm(folder, size, rng, cellsize=1.0):
+    """Gently sloping terrain with some relief, as a tiled GeoTIFF."""
+    path = os.path.join(folder, 'dtm.tif')
+    rows, cols = np.mgrid[0:size, 0:size]
+    dtm = (10.0 + 0.002 * cols + 0.001 * rows + smooth_field(rng, size, 15, 40)).astype(np.float32)
+    write_grid(path, dtm, from_origin(X_ORIGIN, Y_ORIGIN + size * cellsize, cellsize, cellsize))
+    return path
+
+
+def make_channels(folder, size, rng, cellsize=1.0):
+    """Meandering reaches across the DTM with the attributes excavate_trapezium expects."""
+    path = os.path.join(folder, 'channels.shp')
+    extent = size * cellsize
+    n_channels = max(2, size // 100)
+    records = []
+    for _ in range(n_channels):
+        y0, y1 = rng.uniform(0.1, 0.9, 2) * extent
+        xs = np.linspace(0.05, 0.95, 20) * extent
+        ys = np.linspace(y0, y1, 20) + rng.normal(0, 0.02 * extent, 20)
+        records.append({
+            'geometry': LineString(zip(X_ORIGIN + xs, Y_ORIGIN + np.clip(ys, 0, extent))),
+            'BEDLEVELUP': 8.0, 'BEDLEVELDN': 7.0,
+            'BEDWIDTHUP': 4.0, 'BEDWIDTHDN': 6.0,
+            'SLOPEUP': 2.0, 'SLOPEDN': 2.0,
+        })
+    gpd.GeoDataFrame(records, crs=f'EPSG:{EPSG}').to_file(path)
+    return path
+
+
+def make_depth_grids(folder, size, rng, cellsize=1.0):
+    """Baseline and scenario flood depth grids (ASC) with nodata gaps, and a polygon layer."""
+    transform = from_origin(X_ORIGIN, Y_ORIGIN + size * cellsize, cellsize, cellsize)
+    gaps = binary_dilation(rng.random((size, size)) < 0.0005, iterations=8)
+    paths = []
+    for name in ('baseline', 'scenario'):
+        depth = np.clip(smooth_field(rng, size, 10, 4) + 0.5, 0, None).astype(np.float32)
+        depth[gaps] = -9999.0
+        path = os.path.join(folder, f'{name}_dm1maxh0.asc')
+        write_grid(path, depth, transform, driver='AAIGrid')
+        paths.append(path)
+
+    polygons_path = os.path.join(folder, 'polygons.shp')
+    extent = size * cellsize
+    n_polygons = max(4, size // 50)
+    centres = rng.uniform(0.05, 0.95, (n_polygons, 2)) * extent
+    radii = rng.uniform(0.01, 0.05, n_polygons) * extent
+    geometries = [Point(X_ORIGIN + x, Y_ORIGIN + y).buffer(r) for (x, y), r in zip(centres, radii)]
+    gpd.GeoDataFrame({'id': np.arange(n_polygons)}, geometry=geometries, crs=f'EPSG:{EPSG}').to_file(polygons_path)
+    return paths[0], paths[1], polygons_path
+
+
+def make_reference_grid(folder, size, cellsize=1.0, factor=4):
+    """Coarser ASC grid covering the inner part of the DTM, for clip_resample_by_grid."""
+    path = os.path.join(folder, 'reference.asc')
+    n = int(size * 0.8) // factor
+    offset = size * 0.1 * cellsize
+    transform = from_origin(X_ORIGIN + offset, Y_ORIGIN + size * cellsize - offset, cellsize * factor, cellsize * factor)
+    write_grid(path, np.zeros((n, n), dtype=np.float32), transform, driver='AAIGrid')
+    return path
+
+
+def make_precipitation(folder, size, rng, days=2, n_stations=20):
+    """Hourly NSL_YYYYMMDDHH.ASC radar grids and daily station sums for meteobase_grid_correction."""
+    import meteobase_grid_correction as meteobase
+
+    grids_folder = os.path.join(folder, 'RASTER')
+    os.makedirs(grids_folder, exist_ok=True)
+    n = max(20, size // 10)
+    cellsize = 1000.0
+    header = {'ncols': float(n), 'nrows': float(n), 'xllcorner': 0.0, 'yllcorner': 300000.0,
+              'cellsize': cellsize, 'NODATA_value': -9999.0}
+    start = datetime(2020, 1, 1)
+    for day in range(days):
+        date = start + timedelta(days=day)
+        for hour in range(1, 25):
+            data = np.clip(smooth_field(rng, n, 3, 4), 0, None)
+            meteobase.write_ascii_grid(os.path.join(grids_folder, f"NSL_{date:%Y%m%d}{hour:02d}.ASC"), header, data)
+
+    dates = pd.to_datetime([start + timedelta(days=day) for day in range(days)])
+    xs = rng.uniform(-0.05, 1.05, n_stations) * n * cellsize
+    ys = 300000.0 + rng.uniform(-0.05, 1.05, n_stations) * n * cellsize
+    stations = {
+        f'station_{i}': {'X': x, 'Y': y, 'data': pd.DataFrame({'date': dates, 'value': rng.uniform(0, 20, days)})}
+        for i, (x, y) in enumerate(zip(xs, ys))
+    }
+    return grids_folder, stations
+
+
+def make_fixtures(folder, size, days=2, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    baseline, scenario, polygons = make_depth_grids(folder, size, rng)
+    grids_folder, stations = make_precipitation(folder, size, rng, days)
+    return {
+        'dtm': make_dtm(folder, size, rng),
+        'channels': make_channels(folder, size, rng),
+        'baseline': baseline,
+        'scenario': scenario,
+        'polygons': polygons,
+        'reference': make_reference_grid(folder, size),
+        'grids_folder': grids_folder,
+        'stations': stations,
+    }
+
+
+# --- benchmark cases, each runs one script on the fixtures ---
+
+def case_excavate_trapezium(fixtures, output, workers):
+    import excavate_trapezium
+    excavate_trapezium.excavate_trapezium(fixtures['dtm'], fixtures['channels'], os.path.join(output, 'excavated.tif'), 3)
+
+
+def case_excavate_trapezium_parallel(fixtures, output, workers):
+    import excavate_trapezium
+    excavate_trapezium.excavate_trapezium_parallel(fixtures['dtm'], fixtures['channels'], os.path.join(output, 'excavated_parallel.tif'), 3, workers)
+
+
+def case_fill_nodata(fixtures, output, workers):
+    import fill_nodata
+    fill_nodata.fill_nodata(fixtures['baseline'], os.path.join(output, 'filled.asc'), max_search_distance=10)
+
+
+def case_fill_nodata_tiled(fixtures, output, workers):
+    import fill_nodata
+    fill_nodata.fill_nodata_tiled(fixtures['baseline'], os.path.join(output, 'filled_tiled.tif'), max_search_distance=10, workers=workers)
+
+
+def case_fill_nodata_nearest(fixtures, output, workers):
+    import fill_nodata_nearest
+    fill_nodata_nearest.fill_nodata_nearest(fixtures['baseline'], os.path.join(output, 'filled_nearest.asc'), max_search_distance=10)
+
+
+def case_volume_difference_by_polygon(fixtures, output, workers):
+    import volume_difference_by_polygon
+    polygons = gpd.read_file(fixtures['polygons']).geometry
+    volume_difference_by_polygon.zonal_volume_difference(fixtures['baseline'], fixtures['scenario'], polygons)
+
+
+def case_clip_resample_by_grid(fixtures, output, workers):
+    import clip_resample_by_grid
+    clip_resample_by_grid.clip_and_resample(fixtures['dtm'], fixtures['reference'], os.path.join(output, 'resampled.tif'),
+                                            f'EPSG:{EPSG}', 'average')
+
+
+def case_meteobase_grid_correction(fixtures, output, workers):
+    import meteobase_grid_correction as meteobase
+    stations = fixtures['stations']
+    hourly_files = meteobase.find_hourly_files(fixtures['grids_folder'])
+    dates = list(hourly_files.keys())
+    header, _ = meteobase.read_ascii_grid(hourly_files[dates[0]][0])
+    grid_x, grid_y = meteobase.grid_coordinates(header)
+    interpolator = meteobase.StationInterpolator(
+        [info['X'] for info in stations.values()], [info['Y'] for info in stations.values()], grid_x, grid_y)
+    meteobase.adjust_days(hourly_files, interpolator, meteobase.station_values(stations, dates), workers=workers)
+
+
+CASES = {
+    'excavate_trapezium': case_excavate_trapezium,
+    'excavate_trapezium_parallel': case_excavate_trapezium_parallel,
+    'fill_nodata': case_fill_nodata,
+    'fill_nodata_tiled': case_fill_nodata_tiled,
+    'fill_nodata_nearest': case_fill_nodata_nearest,
+    'volume_difference_by_polygon': case_volume_difference_by_polygon,
+    'clip_resample_by_grid': case_clip_resample_by_grid,
+    'meteobase_grid_correction': case_meteobase_grid_correction,
+}
+
+
+# --- measurement ---
+
+def peak_memory_mb():
+    """Peak resident memory (MB) of this process and of its largest finished child process."""
+    own = children = None
+    # on Linux ru_maxrss survives exec, so a spawned process would report the peak of its parent;
+    # VmHWM starts afresh with the new program
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    own = int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        unit = 1 if sys.platform == 'darwin' else 1024
+        if own is None:
+            own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20
+    elif own is None:
+        try:
+            import psutil
+            own = psutil.Process().memory_info().peak_wset / 2 ** 20
+        except (ImportError, AttributeError):
+            pass
+    return own, children
+
+
+def _run_case(name, fixtures, output, workers, queue):
+    # runs in a fresh process, so the peak memory belongs to this case only
+    os.makedirs(output, exist_ok=True)
+    try:
+        start = time.perf_counter()
+        CASES[name](fixtures, output, workers)
+        seconds = time.perf_counter() - start
+        peak, peak_children = peak_memory_mb()
+        queue.put({'seconds': seconds, 'peak_memory_mb': peak, 'peak_worker_memory_mb': peak_children, 'error': None})
+    except Exception:
+        queue.put({'seconds': None, 'peak_memory_mb': None, 'peak_worker_memory_mb': None, 'error': traceback.format_exc()})
+
+
+def run_case(name, fixtures, output, workers):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_case, args=(name, fixtures, output, workers, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': commit,
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'rasterio': rasterio.__version__,
+        'gdal': rasterio.__gdal_version__,
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run_benchmarks(sizes, cases, output_folder, workers=None, repeat=1, days=2, workdir=None):
+    """Run the cases for every size and write the results to a JSON file in output_folder."""
+    workers = workers or os.cpu_count()
+    os.makedirs(output_folder, exist_ok=True)
+    results = {'environment': environment_info(), 'workers': workers, 'results': []}
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        for size in sizes:
+            print(f"Generating fixtures of {size} x {size} cells...")
+            fixtures = make_fixtures(os.path.join(tmp, f'size_{size}'), size, days)
+            for name in cases:
+                for run in range(repeat):
+                    result = run_case(name, fixtures, os.path.join(tmp, f'output_{size}_{name}'), workers)
+                    result.update({'case': name, 'size': size, 'run': run})
+                    results['results'].append(result)
+                    if result['error']:
+                        print(f"{name:>30} | {size:>6} | failed:\n{result['error']}")
+                    else:
+                        print(f"{name:>30} | {size:>6} | {result['seconds']:>8.2f} s | {result['peak_memory_mb'] or 0:>8.0f} MB")
+
+    output_file = os.path.join(output_folder, f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output_file}")
+    return output_file
+
+
+def compare_results(old_file, new_file):
+    """Print the run time and peak memory of new_file relative to old_file, per case and size."""
+    def best(path):
+        with open(path) as f:
+            runs = [r for r in json.load(f)['results'] if not r['error']]
+        table = {}
+        for r in runs:
+            key = (r['case'], r['size'])
+            if key not in table or r['seconds'] < table[key]['seconds']:
+                table[key] = r
+        return table
+
+    old, new = best(old_file), best(new_file)
+    print(f"{'case':>30} | {'size':>6} | {'old (s)':>8} | {'new (s)':>8} | {'time':>6} | {'memory':>6}")
+    for key in sorted(old.keys() & new.keys()):
+        o, n = old[key], new[key]
+        memory = n['peak_memory_mb'] / o['peak_memory_mb'] if o['peak_memory_mb'] and n['peak_memory_mb'] else float('nan')
+        print(f"{key[0]:>30} | {key[1]:>6} | {o['seconds']:>8.2f} | {n['seconds']:>8.2f} | "
+              f"{n['seconds'] / o['seconds']:>5.2f}x | {memory:>5.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the raster scripts on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 2000], help="Raster sizes (cells per side)")
+    parser.add_argument("--cases", nargs='+', default=list(CASES), choices=list(CASES), help="Cases to run")
+    parser.add_argument("--output", type=str, default="benchmark_results", help="Folder for the JSON results")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes for the parallel cases")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs per case and size")
+    parser.add_argument("--days", type=int, default=2, help="Number of days of hourly precipitation grids")
+    parser.add_argument("--workdir", type=str, default=None, help="Folder for the temporary fixtures")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files instead")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+    else:
+        run_benchmarks(args.sizes, args.cases, args.output, args.workers, args.repeat, args.days, args.workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,125 @@
+import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
 import rasterio
-from rasterio.windows import from_bounds
-import numpy as np
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
 
-def clip_and_resample(input_tiff, reference_asc, output_tiff):
-    # Read the reference ASC file
+from raster_io import block_windows
+
+# internal tile size of the output GeoTIFF
+BLOCKSIZE = 256
+
+# size of the windows that are warped and written at once (a multiple of BLOCKSIZE)
+CHUNKSIZE = 2048
+
+
+def read_reference(reference_asc, crs=None):
+    """Grid definition of the reference grid. crs is used when the grid has no CRS of its own (ASC)."""
     with rasterio.open(reference_asc) as ref:
-        ref_profile = ref.profile
-        ref_bounds = ref.bounds
-        ref_transform = ref.transform
-    
-    # Read the input GeoTIFF
+        ref_crs = ref.crs or (CRS.from_user_input(crs) if crs is not None else None)
+        return {
+            'crs': ref_crs,
+            'transform': ref.transform,
+            'width': ref.width,
+            'height': ref.height,
+            # output windows, aligned to the tiles of the output
+            'windows': list(block_windows(ref.width, ref.height, (BLOCKSIZE, BLOCKSIZE), CHUNKSIZE)),
+        }
+
+
+def clip_and_resample(input_tiff, reference_asc, output_tiff, crs=None, resampling='bilinear', num_threads='ALL_CPUS',
+                      warp_mem_limit=256, reference=None):
+    """Clip and resample input_tiff onto the grid of reference_asc.
+
+    The input is warped through a WarpedVRT with the given resampling kernel
+    (a rasterio Resampling name such as 'nearest', 'bilinear', 'cubic' or
+    'average') and written window by window into a tiled GeoTIFF, so neither
+    grid has to fit in memory. warp_mem_limit is in MB. Pass a reference from
+    read_reference to reuse it across many inputs.
+    """
+    if reference is None:
+        reference = read_reference(reference_asc, crs)
+    if isinstance(resampling, str):
+        resampling = Resampling[resampling]
+
     with rasterio.open(input_tiff) as src:
-        # Get the window of the input that matches the reference bounds
-        window = from_bounds(*ref_bounds, src.transform)
-        
-        # Read the data from the window
-        data = src.read(1, window=window)
-        
-        # Resample the data to match the reference resolution
-        new_shape = (ref_profile['height'], ref_profile['width'])
-        resampled_data = np.resize(data, new_shape)
-        
+        src_crs = src.crs or reference['crs']
+        dst_crs = reference['crs'] or src_crs
+        vrt_options = {
+            'src_crs': src_crs,
+            'crs': dst_crs,
+            'transform': reference['transform'],
+            'width': reference['width'],
+            'height': reference['height'],
+            'resampling': resampling,
+            'warp_mem_limit': warp_mem_limit,
+            'warp_extras': {'NUM_THREADS': num_threads},
+        }
+        if src.nodata is not None:
+            vrt_options['nodata'] = src.nodata
+
         # Update the profile for the output file
         dst_profile = src.profile.copy()
         dst_profile.update({
-            'transform': ref_transform,
-            'width': ref_profile['width'],
-            'height': ref_profile['height']
+            'driver': 'GTiff',
+            'crs': dst_crs,
+            'transform': reference['transform'],
+            'width': reference['width'],
+            'height': reference['height'],
+            'tiled': True,
+            'blockxsize': BLOCKSIZE,
+            'blockysize': BLOCKSIZE,
+            'compress': 'deflate',
+            'BIGTIFF': 'IF_SAFER',
         })
-        
-        # Create the output file
-        with rasterio.open(output_tiff, 'w', **dst_profile) as dst:
-            dst.write(resampled_data, 1)
 
-# Example usage
-input_tiff = r'c:\\SYNC\\PROJECTEN\\H3140.RWANDA\\02.Steps\\01a.NewDTMAssessment\\ALL 4 WETLANDS.tif'
-reference_asc = r'c:\\SYNC\\PROJECTEN\\H3140.RWANDA\\02.Steps\\01a.NewDTMAssessment\\lidar_dem_10m_corrected.asc'
-output_tiff = r'c:\\SYNC\\PROJECTEN\\H3140.RWANDA\\02.Steps\\01a.NewDTMAssessment\\ALL 4 WETLANDS_Model.tif'
+        with WarpedVRT(src, **vrt_options) as vrt, rasterio.open(output_tiff, 'w', **dst_profile) as dst:
+            for window in reference['windows']:
+                dst.write(vrt.read(window=window), window=window)
+
+
+def batch_clip_and_resample(input_tiffs, reference_asc, output_folder, crs=None, resampling='bilinear', workers=1,
+                            num_threads='ALL_CPUS', warp_mem_limit=256, suffix='_Model'):
+    """Align many GeoTIFFs to one reference grid, reading the reference only once.
+
+    Output files are written to output_folder as <name><suffix>.tif. With
+    workers > 1 several inputs are warped at the same time.
+    """
+    reference = read_reference(reference_asc, crs)
+    os.makedirs(output_folder, exist_ok=True)
+
+    def process(input_tiff):
+        name = os.path.splitext(os.path.basename(input_tiff))[0]
+        output_tiff = os.path.join(output_folder, f"{name}{suffix}.tif")
+        clip_and_resample(input_tiff, reference_asc, output_tiff, crs, resampling, num_threads, warp_mem_limit, reference)
+        print(f"Resampled {input_tiff} to {output_tiff}")
+        return output_tiff
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(process, input_tiffs))
+
+
+def main():
+    input_tiff = r'c:\\SYNC\\PROJECTEN\\H3140.RWANDA\\02.Steps\\01a.NewDTMAssessment\\ALL 4 WETLANDS.tif'
+    reference_asc = r'c:\\SYNC\\PROJECTEN\\H3140.RWANDA\\02.Steps\\01a.NewDTMAssessment\\lidar_dem_10m_corrected.asc'
+    output_tiff = r'c:\\SYNC\\PROJECTEN\\H3140.RWANDA\\02.Steps\\01a.NewDTMAssessment\\ALL 4 WETLANDS_Model.tif'
+
+    crs = 'PROJCRS["ITRF_2005",BASEGEOGCRS["ITRF2005",DATUM["International Terrestrial Reference Frame 2005",ELLIPSOID["GRS 1980",6378137,298.257222101,LENGTHUNIT["metre",1]],ID["EPSG",6896]],PRIMEM["Greenwich",0,ANGLEUNIT["Degree",0.0174532925199433]]],CONVERSION["unnamed",METHOD["Transverse Mercator",ID["EPSG",9807]],PARAMETER["Latitude of natural origin",0,ANGLEUNIT["Degree",0.0174532925199433],ID["EPSG",8801]],PARAMETER["Longitude of natural origin",30,ANGLEUNIT["Degree",0.0174532925199433],ID["EPSG",8802]],PARAMETER["Scale factor at natural origin",0.9999,SCALEUNIT["unity",1],ID["EPSG",8805]],PARAMETER["False easting",500000,LENGTHUNIT["metre",1],ID["EPSG",8806]],PARAMETER["False northing",5000000,LENGTHUNIT["metre",1],ID["EPSG",8807]]],CS[Cartesian,2],AXIS["(E)",east,ORDER[1],LENGTHUNIT["metre",1,ID["EPSG",9001]]],AXIS["(N)",north,ORDER[2],LENGTHUNIT["metre",1,ID["EPSG",9001]]]]'
+
+    # Resampling kernel: 'nearest', 'bilinear', 'cubic', 'average', ...
+    resampling = 'average'
+
+    # Set an input folder to align all GeoTIFFs in it to the reference grid instead of a single file
+    input_folder = None
+
+    if input_folder:
+        input_tiffs = glob.glob(os.path.join(input_folder, '*.tif'))
+        batch_clip_and_resample(input_tiffs, reference_asc, os.path.join(input_folder, 'resampled'), crs, resampling)
+    else:
+        clip_and_resample(input_tiff, reference_asc, output_tiff, crs, resampling)
 
-crs = 'PROJCRS["ITRF_2005",BASEGEOGCRS["ITRF2005",DATUM["International Terrestrial Reference Frame 2005",ELLIPSOID["GRS 1980",6378137,298.257222101,LENGTHUNIT["metre",1]],ID["EPSG",6896]],PRIMEM["Greenwich",0,ANGLEUNIT["Degree",0.0174532925199433]]],CONVERSION["unnamed",METHOD["Transverse Mercator",ID["EPSG",9807]],PARAMETER["Latitude of natural origin",0,ANGLEUNIT["Degree",0.0174532925199433],ID["EPSG",8801]],PARAMETER["Longitude of natural origin",30,ANGLEUNIT["Degree",0.0174532925199433],ID["EPSG",8802]],PARAMETER["Scale factor at natural origin",0.9999,SCALEUNIT["unity",1],ID["EPSG",8805]],PARAMETER["False easting",500000,LENGTHUNIT["metre",1],ID["EPSG",8806]],PARAMETER["False northing",5000000,LENGTHUNIT["metre",1],ID["EPSG",8807]]],CS[Cartesian,2],AXIS["(E)",east,ORDER[1],LENGTHUNIT["metre",1,ID["EPSG",9001]]],AXIS["(N)",north,ORDER[2],LENGTHUNIT["metre",1,ID["EPSG",9001]]]]'
 
-clip_and_resample(input_tiff, reference_asc, output_tiff, crs)
+if __name__ == "__main__":
+    main()
@@ -1,108 +1,303 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import rasterio
 import geopandas as gpd
 import numpy as np
+import shapely
 from rasterio.features import geometry_mask
-from shapely.geometry import Point, LineString, box
-from rtree import index
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import transform as window_transform
 
-def nearest_channel_segment(point, linestring):
-    min_dist = float('inf')
-    nearest_segment = None
-    nearest_fraction = None
+from raster_io import bounded_map, init_worker_reader, worker_reader
 
-    for i in range(len(linestring.coords) - 1):
-        segment = LineString([linestring.coords[i], linestring.coords[i + 1]])
-        dist = point.distance(segment)
-        if dist < min_dist:
-            min_dist = dist
-            nearest_segment = segment
-            nearest_fraction = segment.project(point) / segment.length
-        print(f"Segment: {segment}, Distance: {dist}, Min Distance: {min_dist}")
+# maximum number of cell/segment combinations evaluated at once (limits memory use)
+PROJECTION_CHUNK = 4_000_000
 
-    return nearest_segment, nearest_fraction
+# number of cells whose candidate segments are looked up in the segment tree at once
+QUERY_CHUNK = 65_536
 
+# internal tile size of the windowed GeoTIFF output
+BLOCKSIZE = 256
 
-elevation_tiff = 'C:\\SYNC\\PROJECTEN\\H3115.SIBELCO.Pilots\\02.Devon\\01.GIS\\UK_ND_Lidar_2022_DTM_20221230_05_interpolated.tif'
-channel_shapefile = 'C:\\SYNC\\PROJECTEN\\H3115.SIBELCO.Pilots\\02.Devon\\03.ChannelBuilder\\input\\Rivers_subselection_refined.shp'
-output_tiff = 'C:\\SYNC\\PROJECTEN\\H3115.SIBELCO.Pilots\\02.Devon\\01.GIS\\UK_ND_Lidar_2022_DTM_20221230_05_interpolated_excavated.tif'
-maxdepth = 3
+# channel attributes needed by the excavation
+CHANNEL_FIELDS = ['geometry', 'BEDLEVELUP', 'BEDLEVELDN', 'BEDWIDTHUP', 'BEDWIDTHDN', 'SLOPEUP', 'SLOPEDN']
 
-with rasterio.open(elevation_tiff) as elevation_src:
-    elevation = elevation_src.read(1)
-    elevation_transform = elevation_src.transform
 
-channels = gpd.read_file(channel_shapefile)
+def project_on_channel(xs, ys, linestring, max_distance=None):
+    """Project points onto a channel linestring.
 
-idx = index.Index()
+    Returns, per point, the index of the nearest segment, the chainage as a
+    fraction (0 = upstream, 1 = downstream) of the total channel length and
+    the distance to the channel. With max_distance (all points lie within
+    that distance of the channel) each point is only projected onto the
+    segments within that distance, found with an STRtree of the segments.
+    """
+    coords = np.asarray(linestring.coords)[:, :2]
+    start = coords[:-1]
+    delta = coords[1:] - start
+    seg_len2 = (delta ** 2).sum(axis=1)
+    seg_len = np.sqrt(seg_len2)
+    cum_len = np.concatenate(([0.0], np.cumsum(seg_len)))
+    total_len = cum_len[-1]
 
-mask = np.zeros(elevation.shape, dtype=bool)
-for _, channel in channels.iterrows():
-    linestring = channel['geometry']
-    max_buf_distance = channel['BEDWIDTHUP'] / 2 + maxdepth * channel['SLOPEUP']
-    buffer = linestring.buffer(max_buf_distance)
-    masked = geometry_mask([buffer], transform=elevation_transform, out_shape=elevation.shape, invert=True)
-    mask |= masked
+    # zero-length segments (duplicate vertices) are projected onto their start point
+    inv_len2 = np.divide(1.0, seg_len2, out=np.zeros_like(seg_len2), where=seg_len2 > 0)
+
+    n_points = len(xs)
+    segment = np.empty(n_points, dtype=np.int64)
+    t_nearest = np.empty(n_points, dtype=np.float64)
+    distance = np.empty(n_points, dtype=np.float64)
+
+    def project(points, segments):
+        # projection of each point onto the corresponding segment: position t along it and squared distance
+        px = xs[points] - start[segments, 0]
+        py = ys[points] - start[segments, 1]
+        t = np.clip((px * delta[segments, 0] + py * delta[segments, 1]) * inv_len2[segments], 0.0, 1.0)
+        return t, (px - t * delta[segments, 0]) ** 2 + (py - t * delta[segments, 1]) ** 2
+
+    unmatched = np.arange(n_points)
+    if max_distance is not None and len(start) > 1:
+        tree = shapely.STRtree(shapely.linestrings(np.stack([start, coords[1:]], axis=1)))
+        # a little extra distance, so rounding does not drop the nearest segment of a point at max_distance
+        search_distance = max_distance * (1 + 1e-9) + 1e-9
+        found = np.zeros(n_points, dtype=bool)
+        for i in range(0, n_points, QUERY_CHUNK):
+            chunk_points = shapely.points(xs[i:i + QUERY_CHUNK], ys[i:i + QUERY_CHUNK])
+            points, segments = tree.query(chunk_points, predicate='dwithin', distance=search_distance)
+            if len(points) == 0:
+                continue
+            points += i
+            t, dist2 = project(points, segments)
+            # nearest candidate per point; on equal distance the first segment, like argmin
+            order = np.lexsort((segments, dist2, points))
+            first = order[np.r_[True, points[order][1:] != points[order][:-1]]]
+            nearest_points = points[first]
+            segment[nearest_points] = segments[first]
+            t_nearest[nearest_points] = t[first]
+            distance[nearest_points] = np.sqrt(dist2[first])
+            found[nearest_points] = True
+        unmatched = np.flatnonzero(~found)
+
+    # points without candidates (or without max_distance) are projected onto every segment
+    chunk = max(1, PROJECTION_CHUNK // len(start))
+    for i in range(0, len(unmatched), chunk):
+        points = unmatched[i:i + chunk]
+        t, dist2 = project(points[:, None], np.arange(len(start))[None, :])
+        nearest = np.argmin(dist2, axis=1)
+        rows = np.arange(len(nearest))
+        segment[points] = nearest
+        t_nearest[points] = t[rows, nearest]
+        distance[points] = np.sqrt(dist2[rows, nearest])
 
-    cell_id = 0
-    for row, col in np.argwhere(masked):
-        x, y = elevation_src.xy(row, col)
-        idx.insert(cell_id, (x, y, x, y), (row, col))
-        cell_id += 1
+    chainage = cum_len[segment] + t_nearest * seg_len[segment]
+    fraction = chainage / total_len if total_len > 0 else np.zeros(n_points)
+    return segment, fraction, distance
 
-total_channels = len(channels)
 
-for channel_idx, (_, channel) in enumerate(channels.iterrows(), start=1):
-    print(f"Processing channel {channel_idx} of {total_channels}")
+def buffer_distance(channel, maxdepth):
+    # half the widest bed plus the horizontal extent of the widest slope
+    bed_width = max(channel['BEDWIDTHUP'], channel['BEDWIDTHDN'])
+    slope = max(channel['SLOPEUP'], channel['SLOPEDN'])
+    return bed_width / 2 + maxdepth * slope
 
+
+def buffer_window(bounds, transform, height, width):
+    """Whole-pixel window covering the given bounds, clipped to the raster."""
+    window = from_bounds(*bounds, transform=transform)
+    col_off = max(int(np.floor(window.col_off)), 0)
+    row_off = max(int(np.floor(window.row_off)), 0)
+    col_end = min(int(np.ceil(window.col_off + window.width)), width)
+    row_end = min(int(np.ceil(window.row_off + window.height)), height)
+    if col_end <= col_off or row_end <= row_off:
+        return None
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def excavate_channel(elevation, transform, channel, maxdepth, nodata=None):
+    """Excavate the trapezium profile of one channel into an elevation array.
+
+    The array is modified in place. It may be a window of the full grid, as
+    long as transform is the transform of that window.
+    """
     linestring = channel['geometry']
-    max_buf_distance = channel['BEDWIDTHUP'] / 2 + maxdepth * channel['SLOPEUP']
-    buffer = linestring.buffer(max_buf_distance)
-    bounds = buffer.bounds
-
-    for item in idx.intersection(bounds, objects=True):
-        x_min, y_min, x_max, y_max = item.bbox
-        row, col = item.object
-        x, y = elevation_src.xy(row, col)
-        point = Point(x, y)
-        
-        # Rest of the code
-
-        nearest_segment, nearest_fraction = nearest_channel_segment(point, linestring)
-        bed_level_up = channel['BEDLEVELUP']
-        bed_level_dn = channel['BEDLEVELDN']
-        bed_width_up = channel['BEDWIDTHUP']
-        bed_width_dn = channel['BEDWIDTHDN']
-        slope_up = channel['SLOPEUP']
-        slope_dn = channel['SLOPEDN']
-
-
-        bed_level = bed_level_up + nearest_fraction * (bed_level_dn - bed_level_up)
-        bed_width = bed_width_up + nearest_fraction * (bed_width_dn - bed_width_up)
-       
-        slope = slope_up + nearest_fraction * (slope_dn - slope_up)
-
-        dist_from_channel = point.distance(nearest_segment)
-
-        if dist_from_channel <= bed_width / 2:
-            z_min = bed_level - dist_from_channel / slope
-            z_max = bed_level + dist_from_channel / slope
-            z = elevation[row, col]
-
-            if z_min <= z <= z_max:
-                elevation[row, col] = max(z_min, z - maxdepth)
-    break
-
-# Save the modified elevation grid to a new GeoTIFF
-
-with rasterio.open(
-    output_tiff,
-    'w',
-    driver='GTiff',
-    height=elevation.shape[0],
-    width=elevation.shape[1],
-    count=1,
-    dtype=elevation.dtype,
-    crs=elevation_src.crs,
-    transform=elevation_transform,
-) as dst:
-    dst.write(elevation, 1)
+    max_distance = buffer_distance(channel, maxdepth)
+    buffer = linestring.buffer(max_distance)
+    masked = geometry_mask([buffer], transform=transform, out_shape=elevation.shape, invert=True)
+    if nodata is not None:
+        masked &= elevation != nodata
+    rows, cols = np.nonzero(masked)
+    if len(rows) == 0:
+        return 0
+
+    # cell centre coordinates
+    xs, ys = transform * (cols + 0.5, rows + 0.5)
+    _, fraction, distance = project_on_channel(np.asarray(xs), np.asarray(ys), linestring, max_distance)
+
+    bed_level = channel['BEDLEVELUP'] + fraction * (channel['BEDLEVELDN'] - channel['BEDLEVELUP'])
+    bed_width = channel['BEDWIDTHUP'] + fraction * (channel['BEDWIDTHDN'] - channel['BEDWIDTHUP'])
+    slope = channel['SLOPEUP'] + fraction * (channel['SLOPEDN'] - channel['SLOPEUP'])
+
+    # flat bed within the bed width, rising with the (horizontal:vertical) slope outside of it
+    excess = np.maximum(distance - bed_width / 2, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rise = np.where(excess > 0, excess / slope, 0.0)
+    target = bed_level + rise
+
+    z = elevation[rows, cols]
+    lowered = target < z
+    new_z = np.maximum(target, z - maxdepth)
+    elevation[rows[lowered], cols[lowered]] = new_z[lowered]
+    return int(lowered.sum())
+
+
+def excavate_trapezium(elevation_tiff, channel_shapefile, output_tiff, maxdepth):
+    with rasterio.open(elevation_tiff) as elevation_src:
+        original = elevation_src.read(1)
+        profile = elevation_src.profile
+        elevation_transform = elevation_src.transform
+        nodata = elevation_src.nodata
+
+    channels = gpd.read_file(channel_shapefile)
+    total_channels = len(channels)
+    height, width = original.shape
+    elevation = original.copy()
+
+    for channel_idx, (_, channel) in enumerate(channels.iterrows(), start=1):
+        print(f"Processing channel {channel_idx} of {total_channels}")
+        bounds = channel['geometry'].buffer(buffer_distance(channel, maxdepth)).bounds
+        window = buffer_window(bounds, elevation_transform, height, width)
+        if window is None:
+            continue
+        # every channel is excavated into the original elevation and the lowest result is kept,
+        # so maxdepth does not add up where channels cross (the same rule as the parallel variant)
+        slices = window.toslices()
+        excavated = original[slices].copy()
+        if excavate_channel(excavated, window_transform(window, elevation_transform), channel, maxdepth, nodata):
+            np.minimum(elevation[slices], excavated, out=elevation[slices])
+
+    # Save the modified elevation grid to a new GeoTIFF
+    profile.update(driver='GTiff')
+    with rasterio.open(output_tiff, 'w', **profile) as dst:
+        dst.write(elevation, 1)
+
+
+def tiled_profile(profile, blocksize=BLOCKSIZE, compress=None):
+    profile = profile.copy()
+    profile.update(driver='GTiff', tiled=True, blockxsize=blocksize, blockysize=blocksize, BIGTIFF='IF_SAFER')
+    profile.pop('compress', None)
+    if compress is not None:
+        profile['compress'] = compress
+    return profile
+
+
+def copy_to_tiled(elevation_tiff, output_tiff, blocksize=BLOCKSIZE, compress=None):
+    # copy the elevation block by block into a tiled output
+    with rasterio.open(elevation_tiff) as elevation_src:
+        profile = tiled_profile(elevation_src.profile, blocksize, compress)
+        with rasterio.open(output_tiff, 'w', **profile) as dst:
+            for _, block in dst.block_windows(1):
+                dst.write(elevation_src.read(1, window=block), 1, window=block)
+
+
+@contextmanager
+def excavation_output(elevation_tiff, output_tiff, blocksize=BLOCKSIZE):
+    """Tiled copy of the elevation to write the excavated windows into; yields its path.
+
+    GDAL appends every rewritten compressed tile to the file instead of reusing
+    its space, so for a compressed source the windows go into an uncompressed
+    working copy, which is written to output_tiff with the compression of the
+    source at the end.
+    """
+    with rasterio.open(elevation_tiff) as elevation_src:
+        compress = elevation_src.profile.get('compress')
+    if compress is None:
+        copy_to_tiled(elevation_tiff, output_tiff, blocksize)
+        yield output_tiff
+        return
+
+    work_tiff = output_tiff + '.tmp'
+    copy_to_tiled(elevation_tiff, work_tiff, blocksize)
+    try:
+        yield work_tiff
+        copy_to_tiled(work_tiff, output_tiff, blocksize, compress)
+    finally:
+        if os.path.exists(work_tiff):
+            os.remove(work_tiff)
+
+
+def excavate_trapezium_windowed(elevation_tiff, channel_shapefile, output_tiff, maxdepth, blocksize=BLOCKSIZE):
+    """Out-of-core variant: only the windows covering each channel buffer are held in memory."""
+    channels = gpd.read_file(channel_shapefile)
+    total_channels = len(channels)
+
+    # excavate the channels window by window into the original elevation, keeping the lowest result in the output
+    with excavation_output(elevation_tiff, output_tiff, blocksize) as work_tiff, \
+            rasterio.open(elevation_tiff) as src, rasterio.open(work_tiff, 'r+') as dst:
+        for channel_idx, (_, channel) in enumerate(channels.iterrows(), start=1):
+            print(f"Processing channel {channel_idx} of {total_channels}")
+            bounds = channel['geometry'].buffer(buffer_distance(channel, maxdepth)).bounds
+            window = buffer_window(bounds, dst.transform, dst.height, dst.width)
+            if window is None:
+                continue
+            elevation = src.read(1, window=window)
+            if excavate_channel(elevation, dst.window_transform(window), channel, maxdepth, dst.nodata):
+                dst.write(np.minimum(dst.read(1, window=window), elevation), 1, window=window)
+
+
+def _excavate_channel_worker(channel, maxdepth):
+    # excavate one channel on its own window of the original elevation grid
+    reader = worker_reader()
+    src = reader.src
+    bounds = channel['geometry'].buffer(buffer_distance(channel, maxdepth)).bounds
+    window = buffer_window(bounds, src.transform, src.height, src.width)
+    if window is None:
+        return None
+    elevation = reader.read(window)
+    if not excavate_channel(elevation, src.window_transform(window), channel, maxdepth, src.nodata):
+        return None
+    return window, elevation
+
+
+def excavate_trapezium_parallel(elevation_tiff, channel_shapefile, output_tiff, maxdepth, workers=None, blocksize=BLOCKSIZE):
+    """Excavate the channels in a process pool, each on its own window.
+
+    Where channels overlap the lowest excavated elevation is kept, so the
+    result does not depend on the order in which the workers finish.
+    """
+    workers = workers or os.cpu_count()
+    channels = gpd.read_file(channel_shapefile)
+    total_channels = len(channels)
+
+    tasks = ((channel, maxdepth) for channel in channels[CHANNEL_FIELDS].to_dict('records'))
+    with excavation_output(elevation_tiff, output_tiff, blocksize) as work_tiff, \
+            rasterio.open(work_tiff, 'r+') as dst, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker_reader, initargs=(elevation_tiff,)) as executor:
+        results = bounded_map(executor, _excavate_channel_worker, tasks, 2 * workers)
+        for finished, result in enumerate(results, start=1):
+            print(f"Finished channel {finished} of {total_channels}")
+            if result is None:
+                continue
+            window, excavated = result
+            merged = np.minimum(dst.read(1, window=window), excavated)
+            dst.write(merged, 1, window=window)
+
+
+def main():
+    elevation_tiff = 'C:\\SYNC\\PROJECTEN\\H3115.SIBELCO.Pilots\\02.Devon\\01.GIS\\UK_ND_Lidar_2022_DTM_20221230_05_interpolated.tif'
+    channel_shapefile = 'C:\\SYNC\\PROJECTEN\\H3115.SIBELCO.Pilots\\02.Devon\\03.ChannelBuilder\\input\\Rivers_subselection_refined.shp'
+    output_tiff = 'C:\\SYNC\\PROJECTEN\\H3115.SIBELCO.Pilots\\02.Devon\\01.GIS\\UK_ND_Lidar_2022_DTM_20221230_05_interpolated_excavated.tif'
+    maxdepth = 3
+    windowed = True  # read and write only the windows around the channels (for grids that do not fit in memory)
+    workers = 8  # number of processes excavating channels in parallel (1 to run serially)
+
+    if workers > 1:
+        excavate_trapezium_parallel(elevation_tiff, channel_shapefile, output_tiff, maxdepth, workers)
+    elif windowed:
+        excavate_trapezium_windowed(elevation_tiff, channel_shapefile, output_tiff, maxdepth)
+    else:
+        excavate_trapezium(elevation_tiff, channel_shapefile, output_tiff, maxdepth)
+
+
+if __name__ == "__main__":
+    main()
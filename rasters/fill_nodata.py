@@ -5,18 +5,89 @@ Created on Mon Sep 26 22:17:34 2022
 @author: SiebeBosch
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import rasterio
 from rasterio.fill import fillnodata
+from rasterio.windows import Window
 
-srcfile = r"c:\SYNC\PROJECTEN\H3111.Brede.Watersysteemevaluatie.Geleenbeek\07.Resultaten\Scenario's\Geactualiseerd8\mr3_iter3_T25\dm1maxh0.asc"
-dstfile = r"c:\SYNC\PROJECTEN\H3111.Brede.Watersysteemevaluatie.Geleenbeek\07.Resultaten\Scenario's\Geactualiseerd8\mr3_iter3_T25\dm1maxh0_gapfill.tif"
+from raster_io import block_windows, bounded_map, init_worker_dataset, worker_dataset
 
-with rasterio.open(srcfile) as src:
-    profile = src.profile
-    arr = src.read(1)
-    arr_filled = fillnodata(arr, mask=src.read_masks(1), max_search_distance=10, smoothing_iterations=0)
+# size of the tiles that are filled at once, and the internal tile size of the tiled output
+TILESIZE = 1024
+BLOCKSIZE = 256
 
-with rasterio.open(dstfile, 'w', **profile) as dest:
-    dest.write_band(1, arr_filled)
-    
-    
\ No newline at end of file
+
+def fill_nodata(srcfile, dstfile, max_search_distance=10, smoothing_iterations=0):
+    with rasterio.open(srcfile) as src:
+        profile = src.profile
+        arr = src.read(1)
+        arr_filled = fillnodata(arr, mask=src.read_masks(1), max_search_distance=max_search_distance, smoothing_iterations=smoothing_iterations)
+
+    with rasterio.open(dstfile, 'w', **profile) as dest:
+        dest.write_band(1, arr_filled)
+
+
+def _fill_tile(window, halo, max_search_distance, smoothing_iterations):
+    # read the tile with a halo, so cells near the tile edge can find the same valid cells as in an untiled fill;
+    # the halo is read directly, a block cache would read whole neighbouring tiles for it
+    src = worker_dataset()
+    col_off = max(window.col_off - halo, 0)
+    row_off = max(window.row_off - halo, 0)
+    col_end = min(window.col_off + window.width + halo, src.width)
+    row_end = min(window.row_off + window.height + halo, src.height)
+    read_window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+    arr = src.read(1, window=read_window)
+    mask = src.read_masks(1, window=read_window)
+    if mask.all() or not mask.any():
+        # nothing to fill, or nothing to fill it with
+        filled = arr
+    else:
+        filled = fillnodata(arr, mask=mask, max_search_distance=max_search_distance, smoothing_iterations=smoothing_iterations)
+
+    rows = slice(window.row_off - row_off, window.row_off - row_off + window.height)
+    cols = slice(window.col_off - col_off, window.col_off - col_off + window.width)
+    return window, filled[rows, cols]
+
+
+def fill_nodata_tiled(srcfile, dstfile, max_search_distance=10, smoothing_iterations=0, tilesize=TILESIZE, workers=None):
+    """Tiled variant of fill_nodata for rasters that do not fit in memory.
+
+    Every tile is filled with a halo of max_search_distance (+ smoothing_iterations)
+    cells around it, which gives the same result as filling the whole raster at once.
+    The tiles are filled in a process pool and written block by block to a tiled GeoTIFF.
+    """
+    workers = workers or os.cpu_count()
+    halo = int(np.ceil(max_search_distance)) + smoothing_iterations
+
+    with rasterio.open(srcfile) as src:
+        profile = src.profile.copy()
+        width, height = src.width, src.height
+        block_shape = src.block_shapes[0]
+    profile.update(driver='GTiff', tiled=True, blockxsize=BLOCKSIZE, blockysize=BLOCKSIZE, compress='deflate', BIGTIFF='IF_SAFER')
+
+    tiles = ((window, halo, max_search_distance, smoothing_iterations)
+             for window in block_windows(width, height, block_shape, tilesize))
+    with rasterio.open(dstfile, 'w', **profile) as dest, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker_dataset, initargs=(srcfile,)) as executor:
+        for window, filled in bounded_map(executor, _fill_tile, tiles, 2 * workers):
+            dest.write_band(1, filled, window=window)
+
+
+def main():
+    srcfile = r"c:\SYNC\PROJECTEN\H3111.Brede.Watersysteemevaluatie.Geleenbeek\07.Resultaten\Scenario's\Geactualiseerd8\mr3_iter3_T25\dm1maxh0.asc"
+    dstfile = r"c:\SYNC\PROJECTEN\H3111.Brede.Watersysteemevaluatie.Geleenbeek\07.Resultaten\Scenario's\Geactualiseerd8\mr3_iter3_T25\dm1maxh0_gapfill.tif"
+
+    # fill in tiles with a process pool (for large rasters), or the whole raster at once
+    tiled = True
+
+    if tiled:
+        fill_nodata_tiled(srcfile, dstfile, max_search_distance=10, smoothing_iterations=0)
+    else:
+        fill_nodata(srcfile, dstfile, max_search_distance=10, smoothing_iterations=0)
+
+
+if __name__ == "__main__":
+    main()
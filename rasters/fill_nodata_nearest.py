@@ -0,0 +1,68 @@
+"""
+Nearest-neighbour alternative to fill_nodata.py.
+
+rasterio's fillnodata interpolates the gaps with inverse distance weighting.
+This fills every nodata cell with the value of the nearest valid cell
+instead, found for all nodata cells at once with a Euclidean distance
+transform. The filled cells only get values that occur in the grid, e.g. a
+flood depth grid keeps the depths at the edge of a gap.
+
+It is not faster: on the grids of benchmark_fill_nodata.py fillnodata is
+1.2 to 10 times quicker, most of all with a short max_search_distance. Use
+it for the nearest-value result, not for speed.
+"""
+
+import numpy as np
+import rasterio
+from scipy.ndimage import distance_transform_edt
+
+
+def fill_nearest(arr, mask, max_search_distance=None):
+    """Fill the cells where mask == 0 with the value of the nearest valid cell.
+
+    mask follows rasterio's read_masks convention (0 = nodata, non-zero =
+    valid). max_search_distance is in cells, like in fillnodata: cells
+    further away from a valid cell are left as they are. Returns a new array.
+    """
+    invalid = mask == 0
+    if not invalid.any() or invalid.all():
+        return arr.copy()
+
+    # int32 indices halve the memory use compared to the default int64
+    indices = np.empty((arr.ndim,) + arr.shape, dtype=np.int32)
+    distance_transform_edt(invalid, return_distances=False, return_indices=True, indices=indices)
+
+    # only the nodata cells are looked up, their distance follows from the returned indices
+    cells = np.nonzero(invalid)
+    nearest = tuple(index[cells] for index in indices)
+    del indices
+    if max_search_distance is not None:
+        distance2 = sum((cell - near).astype(np.float64) ** 2 for cell, near in zip(cells, nearest))
+        within = distance2 <= max_search_distance ** 2
+        cells = tuple(cell[within] for cell in cells)
+        nearest = tuple(near[within] for near in nearest)
+
+    filled = arr.copy()
+    filled[cells] = arr[nearest]
+    return filled
+
+
+def fill_nodata_nearest(srcfile, dstfile, max_search_distance=None):
+    with rasterio.open(srcfile) as src:
+        profile = src.profile
+        arr = src.read(1)
+        arr_filled = fill_nearest(arr, src.read_masks(1), max_search_distance)
+
+    with rasterio.open(dstfile, 'w', **profile) as dest:
+        dest.write_band(1, arr_filled)
+
+
+def main():
+    srcfile = r"c:\SYNC\PROJECTEN\H3111.Brede.Watersysteemevaluatie.Geleenbeek\07.Resultaten\Scenario's\Geactualiseerd8\mr3_iter3_T25\dm1maxh0.asc"
+    dstfile = r"c:\SYNC\PROJECTEN\H3111.Brede.Watersysteemevaluatie.Geleenbeek\07.Resultaten\Scenario's\Geactualiseerd8\mr3_iter3_T25\dm1maxh0_nearestfill.tif"
+
+    fill_nodata_nearest(srcfile, dstfile, max_search_distance=10)
+
+
+if __name__ == "__main__":
+    main()
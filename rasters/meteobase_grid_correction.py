@@ -1,23 +1,107 @@
 import numpy as np
 import pandas as pd
-from scipy.interpolate import griddata
+from collections import Counter
+from scipy.interpolate import CloughTocher2DInterpolator, griddata
+from scipy.sparse import csr_matrix
+from scipy.spatial import Delaunay
+import netCDF4
 import glob
+from concurrent.futures import ProcessPoolExecutor
+import json
 import os
+from datetime import datetime, timedelta
+
+from raster_io import BlockCache, bounded_map
+
+CUBE_TIME_UNITS = 'hours since 1970-01-01 00:00:00'
+
+# cubic station weights below this are dropped from the weight matrix; the interpolated
+# value then differs less than about 1e-5 times the station values from griddata
+CUBIC_WEIGHT_TOLERANCE = 1e-6
+
+# number of grid cells whose cubic weights are evaluated at once (limits memory use)
+WEIGHT_CHUNK = 5_000
+
+# a pattern of missing stations gets its own precomputed weights once it occurred on this many
+# days, rarer patterns are interpolated with griddata; the weights are kept within the byte budget
+SUBSET_MIN_DAYS = 5
+SUBSET_CACHE_BYTES = 512 * 2 ** 20
+
+def read_ascii_header(file):
+    # the header consists of 'key value' lines, the data starts at the first numeric line
+    header = {}
+    while True:
+        position = file.tell()
+        line = file.readline()
+        parts = line.split()
+        if not parts or not parts[0][0].isalpha():
+            file.seek(position)
+            return header
+        header[parts[0]] = float(parts[1])
+
+def header_value(header, key):
+    # ESRI header keys are case-insensitive
+    for name, value in header.items():
+        if name.lower() == key:
+            return value
+    raise KeyError(key)
+
+def read_ascii_grid(file_path, cache=False):
+    """Read an ESRI ASCII grid, returns (header, data).
+
+    With cache=True the parsed grid is kept in a binary sidecar (<file>.npy plus
+    <file>.npy.json with the header). The sidecar is memory-mapped on the next read
+    and is rebuilt as soon as the size or modification time of the source changes.
+    """
+    if cache:
+        cached = read_grid_cache(file_path)
+        if cached is not None:
+            return cached
 
-def read_ascii_grid(file_path):
     with open(file_path, 'r') as file:
-        header = {}
-        for _ in range(6):
-            line = file.readline().strip().split()
-            header[line[0]] = float(line[1])
-        data = np.loadtxt(file)
+        header = read_ascii_header(file)
+        nrows = int(header_value(header, 'nrows'))
+        ncols = int(header_value(header, 'ncols'))
+        data = np.loadtxt(file, dtype=np.float64)
+    if data.size != nrows * ncols:
+        raise ValueError(f"{file_path}: expected {nrows * ncols} values, found {data.size}")
+    data = data.reshape(nrows, ncols)
+
+    if cache:
+        write_grid_cache(file_path, header, data)
     return header, data
 
-def write_ascii_grid(file_path, header, data):
+def grid_cache_stamp(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def read_grid_cache(file_path):
+    try:
+        with open(file_path + '.npy.json', 'r') as file:
+            meta = json.load(file)
+        if meta['source'] != grid_cache_stamp(file_path):
+            return None
+        data = np.load(file_path + '.npy', mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    return meta['header'], np.asarray(data)
+
+def write_grid_cache(file_path, header, data):
+    try:
+        np.save(file_path + '.npy', data)
+        # the json is written last, it marks the sidecar as complete
+        with open(file_path + '.npy.json', 'w') as file:
+            json.dump({'header': header, 'source': grid_cache_stamp(file_path)}, file)
+    except OSError as e:
+        print(f"Could not write grid cache for {file_path}: {e}")
+
+def write_ascii_grid(file_path, header, data, fmt='%.10f'):
     with open(file_path, 'w') as file:
         for key, value in header.items():
+            if key.lower() in ('ncols', 'nrows'):
+                value = int(value)
             file.write(f"{key} {value}\n")
-        np.savetxt(file, data, fmt='%.10f')
+        np.savetxt(file, data, fmt=fmt)
 
 def read_excel_daily_precipitation(file_path):
     df = pd.read_excel(file_path, sheet_name='Basis.Neerslag.Etmaal', header=6)
@@ -37,80 +121,309 @@ def read_excel_daily_precipitation(file_path):
     print(stations)
     return stations
 
-def calculate_daily_sums(hourly_files):
-    daily_sums = {}
-    for date, files in hourly_files.items():
-        daily_data = None
-        for file in files:
-            header, data = read_ascii_grid(file)
-            if daily_data is None:
-                daily_data = np.zeros_like(data)
-            daily_data += data
-        daily_sums[date] = (header, daily_data)
-    return daily_sums
-
-def spatial_interpolation(stations, grid_x, grid_y):
-    points = []
-    values = []
-    for station, info in stations.items():
-        x = info['X']
-        y = info['Y']
-        data = info['data'].set_index(0)
-        for date, value in data.iterrows():
-            points.append((x, y))
-            values.append(value[1])
-    interpolated = griddata(points, values, (grid_x, grid_y), method='cubic')
-    return interpolated
-
-def apply_multipliers(daily_sums, interpolated_sums):
-    multipliers = {}
-    for date, (header, daily_grid) in daily_sums.items():
-        interpolated_grid = interpolated_sums[date]
+class StationInterpolator:
+    """Interpolates station values to a fixed grid with precomputed weights.
+
+    The Delaunay triangulation of the stations is built once and turned into a
+    sparse (grid cells x stations) weight matrix. Interpolating any number of
+    dates is then a single sparse matrix product. method='linear' gives
+    barycentric weights, method='cubic' the Clough-Tocher weights that griddata
+    uses, without the weights below CUBIC_WEIGHT_TOLERANCE. Grid cells outside
+    the convex hull of the stations become NaN.
+
+    Stations without a value (NaN) on a date are left out for that date: the
+    date is interpolated from the other stations. A pattern of missing stations
+    that occurs on subset_min_days days or more gets its own precomputed
+    weights, kept in an LRU cache of subset_cache_bytes; rarer patterns are
+    interpolated with griddata.
+    """
+
+    def __init__(self, station_x, station_y, grid_x, grid_y, method='cubic',
+                 subset_min_days=SUBSET_MIN_DAYS, subset_cache_bytes=SUBSET_CACHE_BYTES):
+        points = np.column_stack([station_x, station_y]).astype(np.float64)
+        targets = np.column_stack([np.ravel(grid_x), np.ravel(grid_y)]).astype(np.float64)
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.method = method
+        self.points = points
+        self.targets = targets
+        self.shape = np.shape(grid_x)
+        self.n_stations = len(points)
+        self.subset_min_days = subset_min_days
+        # interpolators of the stations with a value, keyed by that selection, and the
+        # number of days each selection occurred on so far
+        self.subsets = BlockCache(subset_cache_bytes)
+        self.pattern_days = Counter()
+
+        triangulation = Delaunay(points)
+        simplex = triangulation.find_simplex(targets)
+        self.outside = simplex < 0
+
+        if method == 'linear':
+            inside = np.flatnonzero(~self.outside)
+            affine = triangulation.transform[simplex[inside]]
+            b = np.einsum('ijk,ik->ij', affine[:, :2], targets[inside] - affine[:, 2])
+            barycentric = np.column_stack([b, 1 - b.sum(axis=1)])
+            rows = np.repeat(inside, 3)
+            cols = triangulation.simplices[simplex[inside]].ravel()
+            self.weights = csr_matrix((barycentric.ravel(), (rows, cols)), shape=(len(targets), self.n_stations))
+        elif method == 'cubic':
+            # the Clough-Tocher interpolant is linear in the station values, so interpolating the
+            # unit vectors gives the weight of every station for every grid cell
+            clough_tocher = CloughTocher2DInterpolator(triangulation, np.eye(self.n_stations))
+            data, indices, row_counts = [], [], []
+            for start in range(0, len(targets), WEIGHT_CHUNK):
+                unit = clough_tocher(targets[start:start + WEIGHT_CHUNK])
+                keep = np.abs(unit) >= CUBIC_WEIGHT_TOLERANCE  # False for NaN (outside the hull)
+                data.append(unit[keep].astype(np.float32))
+                indices.append(np.nonzero(keep)[1].astype(np.int32))
+                row_counts.append(keep.sum(axis=1))
+            indptr = np.concatenate([[0], np.cumsum(np.concatenate(row_counts))]).astype(np.int64)
+            self.weights = csr_matrix((np.concatenate(data), np.concatenate(indices), indptr),
+                                      shape=(len(targets), self.n_stations))
+        else:
+            raise ValueError(f"Unsupported interpolation method: {method}")
+
+    def __call__(self, values):
+        """Interpolate a (stations,) vector or a (dates x stations) matrix to the grid."""
+        values = np.asarray(values, dtype=np.float64)
+        stacked = np.atleast_2d(values)
+        valid = np.isfinite(stacked)
+        if valid.all():
+            interpolated = (self.weights @ stacked.T).T
+            interpolated[:, self.outside] = np.nan
+            interpolated = interpolated.reshape((len(stacked),) + self.shape)
+        else:
+            interpolated = np.full((len(stacked),) + self.shape, np.nan)
+            patterns, pattern_index = np.unique(valid, axis=0, return_inverse=True)
+            for i, pattern in enumerate(patterns):
+                rows = pattern_index.ravel() == i
+                interpolated[rows] = self.interpolate_subset(pattern, stacked[rows][:, pattern])
+        return interpolated[0] if values.ndim == 1 else interpolated
+
+    @property
+    def nbytes(self):
+        weights = self.weights
+        return weights.data.nbytes + weights.indices.nbytes + weights.indptr.nbytes + self.outside.nbytes
+
+    def interpolate_subset(self, valid, values):
+        """Interpolate a (dates x stations) matrix of only the stations where valid is True."""
+        shape = (len(values),) + self.shape
+        if valid.sum() < 3:
+            # a triangulation needs at least three stations
+            return np.full(shape, np.nan)
+        key = valid.tobytes()
+        subset = self.subsets.get(key)
+        if subset is None:
+            self.pattern_days[key] += len(values)
+            # weights of a subset are about as large as these, build them only when they can be cached
+            if self.pattern_days[key] < self.subset_min_days or self.nbytes > self.subsets.max_bytes:
+                interpolated = griddata(self.points[valid], values.T, self.targets, method=self.method)
+                return interpolated.T.reshape(shape)
+            x, y = self.points[valid].T
+            subset = StationInterpolator(x, y, self.grid_x, self.grid_y, self.method, subset_cache_bytes=0)
+            self.subsets.put(key, subset)
+        return subset(values)
+
+def station_values(stations, dates):
+    """Daily station values as a (dates x stations) matrix, dates formatted as YYYYMMDD."""
+    columns = []
+    for info in stations.values():
+        data = info['data']
+        index = pd.to_datetime(data.iloc[:, 0]).dt.strftime('%Y%m%d')
+        series = pd.Series(pd.to_numeric(data.iloc[:, 1], errors='coerce').values, index=index)
+        series = series[~series.index.duplicated()]
+        columns.append(series.reindex(dates).values)
+    values = np.column_stack(columns)
+    missing = ~np.isfinite(values).all(axis=1)
+    if missing.any():
+        print(f"{int(missing.sum())} of {len(dates)} days miss the value of one or more stations, "
+              f"these days are interpolated from the other stations")
+    return values
+
+def spatial_interpolation(stations, grid_x, grid_y, dates, method='cubic'):
+    station_x = [info['X'] for info in stations.values()]
+    station_y = [info['Y'] for info in stations.values()]
+    interpolator = StationInterpolator(station_x, station_y, grid_x, grid_y, method)
+    interpolated = interpolator(station_values(stations, dates))
+    return dict(zip(dates, interpolated))
+
+def grid_axes(header):
+    # cell centres, with the first row at the top of the grid as in the ASCII file
+    cellsize = header_value(header, 'cellsize')
+    ncols = int(header_value(header, 'ncols'))
+    nrows = int(header_value(header, 'nrows'))
+    x = header_value(header, 'xllcorner') + (np.arange(ncols) + 0.5) * cellsize
+    y = header_value(header, 'yllcorner') + (nrows - np.arange(nrows) - 0.5) * cellsize
+    return x, y
+
+def grid_coordinates(header):
+    return np.meshgrid(*grid_axes(header))
+
+def hourly_timestamp(file):
+    # NSL_YYYYMMDDHH: HH runs from 01 to 24 and marks the end of the hour
+    name = os.path.basename(file)
+    return datetime.strptime(name[4:12], '%Y%m%d') + timedelta(hours=int(name[12:14]))
+
+def create_cube(cube_path, header, epsg=28992, chunk_hours=24):
+    """Create an empty, compressed NetCDF cube for hourly grids of the given ASCII header.
+
+    Time is an unlimited dimension chunked per chunk_hours, so appending a day
+    and reading a time range only touch the chunks involved.
+    """
+    x, y = grid_axes(header)
+    with netCDF4.Dataset(cube_path, 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('y', len(y))
+        ds.createDimension('x', len(x))
+
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = CUBE_TIME_UNITS
+        time.standard_name = 'time'
+        x_var = ds.createVariable('x', 'f8', ('x',))
+        x_var.units = 'm'
+        x_var.standard_name = 'projection_x_coordinate'
+        x_var[:] = x
+        y_var = ds.createVariable('y', 'f8', ('y',))
+        y_var.units = 'm'
+        y_var.standard_name = 'projection_y_coordinate'
+        y_var[:] = y
+
+        crs = ds.createVariable('crs', 'i4')
+        crs.epsg_code = f'EPSG:{epsg}'
+        crs.spatial_ref = f'EPSG:{epsg}'
+
+        try:
+            nodata = header_value(header, 'nodata_value')
+        except KeyError:
+            nodata = -9999.0
+        precipitation = ds.createVariable(
+            'precipitation', 'f4', ('time', 'y', 'x'), zlib=True, complevel=4, shuffle=True,
+            chunksizes=(chunk_hours, len(y), len(x)), fill_value=nodata)
+        precipitation.units = 'mm'
+        precipitation.long_name = 'adjusted hourly precipitation'
+        precipitation.grid_mapping = 'crs'
+
+def append_to_cube(cube_path, times, grids):
+    """Append hourly grids to the cube, timestamps already in the cube are skipped."""
+    with netCDF4.Dataset(cube_path, 'a') as ds:
+        time = ds.variables['time']
+        values = netCDF4.date2num(times, CUBE_TIME_UNITS)
+        start = len(time)
+        if start:
+            new = values > time[start - 1]
+            if not new.all():
+                print(f"Skipping {int((~new).sum())} timesteps that are already in {cube_path}")
+            values = values[new]
+            grids = grids[new]
+        if len(values) == 0:
+            return
+        time[start:start + len(values)] = values
+        ds.variables['precipitation'][start:start + len(values)] = grids
+
+def read_cube(cube_path, start_time, end_time):
+    """Read the hourly grids with start_time <= time <= end_time from the cube, returns (times, grids)."""
+    with netCDF4.Dataset(cube_path, 'r') as ds:
+        time = ds.variables['time'][:]
+        first = np.searchsorted(time, netCDF4.date2num(start_time, CUBE_TIME_UNITS), side='left')
+        last = np.searchsorted(time, netCDF4.date2num(end_time, CUBE_TIME_UNITS), side='right')
+        times = netCDF4.num2date(time[first:last], CUBE_TIME_UNITS, only_use_cftime_datetimes=False)
+        return times, ds.variables['precipitation'][first:last]
+
+def find_hourly_files(grids_folder):
+    """Hourly NSL_YYYYMMDDHH*.ASC grids in the folder, grouped by date (YYYYMMDD)."""
+    hourly_files = {}
+    for file in sorted(glob.glob(os.path.join(grids_folder, 'NSL_*.ASC'))):
+        name = os.path.basename(file)
+        if name.upper().endswith('_ADJUSTED.ASC'):
+            continue
+        hourly_files.setdefault(name[4:12], []).append(file)
+    return hourly_files
+
+def day_multiplier(daily_grid, interpolated_grid):
+    with np.errstate(divide='ignore', invalid='ignore'):
         multiplier_grid = interpolated_grid / daily_grid
-        multiplier_grid[np.isnan(multiplier_grid)] = 1
-        multipliers[date] = multiplier_grid
-    return multipliers
+    # no correction where the radar or the stations give no usable daily sum
+    multiplier_grid[~np.isfinite(multiplier_grid)] = 1
+    return multiplier_grid
+
+def adjust_day(files, interpolated_grid, cache=False, to_cube=False):
+    """Adjust the hourly grids of one day to the interpolated daily station sum.
+
+    Every hourly grid is read once; the grids are summed, the multiplier is
+    computed and the adjusted grids are written while still in memory. With
+    to_cube=True nothing is written, the timestamps and the stack of adjusted
+    grids are returned for the cube instead.
+    """
+    grids = [read_ascii_grid(file, cache) for file in files]
+    daily_grid = np.sum([data for _, data in grids], axis=0)
+    multiplier_grid = day_multiplier(daily_grid, interpolated_grid)
+    if to_cube:
+        adjusted = np.stack([data * multiplier_grid for _, data in grids]).astype(np.float32)
+        return [hourly_timestamp(file) for file in files], adjusted
+    for file, (header, data) in zip(files, grids):
+        write_ascii_grid(file.replace('.ASC', '_adjusted.ASC'), header, data * multiplier_grid)
+    return None
+
+def adjust_days(hourly_files, interpolator, daily_values, cache=False, workers=None, max_pending_days=None, cube_path=None):
+    """Run adjust_day for every date in a process pool.
 
-def adjust_hourly_grids(hourly_files, multipliers):
-    for date, files in hourly_files.items():
-        for file in files:
-            header, data = read_ascii_grid(file)
-            adjusted_data = data * multipliers[date]
-            write_ascii_grid(file.replace('.ASC', '_adjusted.ASC'), header, adjusted_data)
+    daily_values is the (dates x stations) matrix in the order of hourly_files.
+    At most max_pending_days days are queued, running or waiting to be appended
+    to the cube at any time, which caps the memory use to a few days' worth of
+    grids. With a cube_path the adjusted grids are appended to that NetCDF
+    cube in date order instead of being written as _adjusted.ASC files.
+    """
+    workers = workers or os.cpu_count()
+    max_pending_days = max_pending_days or 2 * workers
+    total_days = len(hourly_files)
+    to_cube = cube_path is not None
+
+    if to_cube and not os.path.exists(cube_path):
+        first_files = next(iter(hourly_files.values()))
+        create_cube(cube_path, read_ascii_grid(first_files[0], cache)[0])
+
+    # the station sums are interpolated just before a day is submitted
+    days = ((files, interpolator(values), cache, to_cube) for files, values in zip(hourly_files.values(), daily_values))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # the cube is appended in date order; a finished day waiting for an earlier one counts as pending
+        results = bounded_map(executor, adjust_day, days, max_pending_days, ordered=to_cube)
+        for finished, result in enumerate(results, start=1):
+            print(f"Adjusted day {finished} of {total_days}")
+            if to_cube:
+                append_to_cube(cube_path, *result)
 
 def main():
     # Specify the folder containing the precipitation grids
     grids_folder = r'c:\SYNC\PROJECTEN\H3118.HenA.Begeleiding\05.Analyse\Meteobase\RASTER'
 
-    # Initialize the dictionary to store hourly files
-    hourly_files = {}
+    # Keep binary copies of the parsed grids next to the ASCII files, so repeated runs skip the text parsing
+    use_grid_cache = True
 
-    # Use glob to find all relevant ASCII grid files in the specified folder
-    for file in glob.glob(os.path.join(grids_folder, 'NSL_*.ASC')):
-        date = file[4:12]
-        if date not in hourly_files:
-            hourly_files[date] = []
-        hourly_files[date].append(file)
+    # Number of days processed in parallel
+    workers = 8
 
-    daily_sums = calculate_daily_sums(hourly_files)
+    # Write the adjusted grids into one compressed NetCDF cube instead of one _adjusted.ASC file per hour,
+    # e.g. os.path.join(grids_folder, 'NSL_adjusted.nc'). An existing cube is appended to.
+    cube_path = None
+
+    hourly_files = find_hourly_files(grids_folder)
+    dates = list(hourly_files.keys())
     
     stations = read_excel_daily_precipitation(r'c:\SYNC\PROJECTEN\H3118.HenA.Begeleiding\05.Analyse\Meteobase\Bestelling_5239_5898_etmaalstations.xlsx')
     
     # Ensure header is available by reading one of the hourly files
-    sample_header, _ = read_ascii_grid(next(iter(hourly_files.values()))[0])
-    
-    grid_x, grid_y = np.meshgrid(
-        np.arange(sample_header['xllcorner'], sample_header['xllcorner'] + sample_header['ncols'] * sample_header['cellsize'], sample_header['cellsize']),
-        np.arange(sample_header['yllcorner'], sample_header['yllcorner'] + sample_header['nrows'] * sample_header['cellsize'], sample_header['cellsize'])
-    )
+    sample_header, _ = read_ascii_grid(hourly_files[dates[0]][0], use_grid_cache)
     
-    interpolated_sums = {}
-    for date in daily_sums.keys():
-        interpolated_sums[date] = spatial_interpolation(stations, grid_x, grid_y)
+    grid_x, grid_y = grid_coordinates(sample_header)
     
-    multipliers = apply_multipliers(daily_sums, interpolated_sums)
+    # triangulate the stations once, the daily sums are interpolated per day as the days are processed
+    station_x = [info['X'] for info in stations.values()]
+    station_y = [info['Y'] for info in stations.values()]
+    interpolator = StationInterpolator(station_x, station_y, grid_x, grid_y)
+    daily_values = station_values(stations, dates)
     
-    adjust_hourly_grids(hourly_files, multipliers)
+    adjust_days(hourly_files, interpolator, daily_values, use_grid_cache, workers, cube_path=cube_path)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,216 @@
+"""
+Shared windowed raster access for the scripts in this folder.
+
+- block_windows / dataset_windows: iterate over a raster in windows that are
+  aligned to its internal tiling (whole blocks, never half a tile)
+- BlockCache / CachedReader: read arbitrary windows through an LRU cache of
+  blocks with a byte budget, so overlapping or repeated reads do not go back
+  to disk
+- valid_mask / nodata_mask: one definition of nodata (the nodata value or NaN)
+- init_worker_dataset / worker_dataset, init_worker_reader / worker_reader:
+  one open dataset or CachedReader per worker process of a pool
+- bounded_map: run tasks in an executor with a limited number in flight
+"""
+
+from collections import OrderedDict, deque
+from concurrent.futures import wait, FIRST_COMPLETED
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+# default budget of a block cache
+DEFAULT_CACHE_BYTES = 256 * 2 ** 20
+
+# default size (in cells) of windows and cache blocks along each axis
+DEFAULT_WINDOW_SIZE = 1024
+
+# dataset and reader opened by init_worker_dataset and init_worker_reader, once per worker process
+_worker_dataset = None
+_worker_reader = None
+
+
+def valid_mask(data, nodata):
+    """True where data holds a value: not equal to nodata and not NaN."""
+    valid = ~np.isnan(data) if np.issubdtype(data.dtype, np.floating) else np.ones(data.shape, dtype=bool)
+    if nodata is not None:
+        valid &= data != nodata
+    return valid
+
+
+def nodata_mask(data, nodata):
+    return ~valid_mask(data, nodata)
+
+
+def _aligned_length(block_length, length, target_size):
+    # blocks that span the whole axis (e.g. the one-row strips of ASCII grids and striped GeoTIFFs)
+    # do not constrain the window along that axis
+    if block_length >= length:
+        return min(target_size, length)
+    return min(max(1, round(target_size / block_length)) * block_length, length)
+
+
+def aligned_size(block_shape, width, height, target_size=DEFAULT_WINDOW_SIZE):
+    """Window (rows, cols) of about target_size cells per axis, in whole internal blocks.
+
+    Along an axis where a block covers the full raster, windows are target_size long.
+    """
+    block_rows, block_cols = block_shape
+    return _aligned_length(block_rows, height, target_size), _aligned_length(block_cols, width, target_size)
+
+
+def block_windows(width, height, block_shape, target_size=DEFAULT_WINDOW_SIZE):
+    """Windows covering a width x height raster, row by row, aligned to block_shape."""
+    rows, cols = aligned_size(block_shape, width, height, target_size)
+    for row_off in range(0, height, rows):
+        for col_off in range(0, width, cols):
+            yield Window(col_off, row_off, min(cols, width - col_off), min(rows, height - row_off))
+
+
+def dataset_windows(src, target_size=DEFAULT_WINDOW_SIZE, band=1):
+    """Windows covering an open dataset, aligned to the internal tiling of the band."""
+    return block_windows(src.width, src.height, src.block_shapes[band - 1], target_size)
+
+
+class BlockCache:
+    """Least-recently-used cache of raster blocks, limited to max_bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+
+    def get(self, key):
+        block = self._blocks.get(key)
+        if block is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._blocks.move_to_end(key)
+        return block
+
+    def put(self, key, block):
+        if block.nbytes > self.max_bytes:
+            return
+        if key in self._blocks:
+            self.nbytes -= self._blocks.pop(key).nbytes
+        self._blocks[key] = block
+        self.nbytes += block.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        self._blocks.clear()
+        self.nbytes = 0
+
+
+class CachedReader:
+    """Reads windows of one band of an open (read-only) dataset through a BlockCache.
+
+    The raster is divided into cache blocks of about block_size cells per axis,
+    aligned to the internal tiling. A window read assembles the blocks it
+    overlaps, reading from disk only the ones that are not cached yet. Several
+    readers can share one cache.
+    """
+
+    def __init__(self, src, band=1, cache=None, block_size=DEFAULT_WINDOW_SIZE):
+        self.src = src
+        self.band = band
+        self.cache = cache if cache is not None else BlockCache()
+        self.nodata = src.nodata
+        self.dtype = np.dtype(src.dtypes[band - 1])
+        self.block_rows, self.block_cols = aligned_size(src.block_shapes[band - 1], src.width, src.height, block_size)
+
+    def _block(self, i, j):
+        key = (self.src.name, self.band, i, j)
+        block = self.cache.get(key)
+        if block is None:
+            window = Window(j * self.block_cols, i * self.block_rows,
+                            min(self.block_cols, self.src.width - j * self.block_cols),
+                            min(self.block_rows, self.src.height - i * self.block_rows))
+            block = self.src.read(self.band, window=window)
+            block.flags.writeable = False
+            self.cache.put(key, block)
+        return block
+
+    def read(self, window=None):
+        """Read a window (whole pixels, inside the raster); a new array is returned."""
+        if window is None:
+            window = Window(0, 0, self.src.width, self.src.height)
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+        if row_off < 0 or col_off < 0 or row_off + height > self.src.height or col_off + width > self.src.width:
+            raise ValueError(f"Window {window} lies (partly) outside of {self.src.name}")
+
+        out = np.empty((height, width), dtype=self.dtype)
+        for i in range(row_off // self.block_rows, (row_off + height - 1) // self.block_rows + 1):
+            for j in range(col_off // self.block_cols, (col_off + width - 1) // self.block_cols + 1):
+                block = self._block(i, j)
+                top, left = i * self.block_rows, j * self.block_cols
+                r0, r1 = max(row_off, top), min(row_off + height, top + block.shape[0])
+                c0, c1 = max(col_off, left), min(col_off + width, left + block.shape[1])
+                out[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = block[r0 - top:r1 - top, c0 - left:c1 - left]
+        return out
+
+    def read_masked(self, window=None):
+        """Read a window as a masked array, nodata and NaN cells masked."""
+        data = self.read(window)
+        return np.ma.masked_array(data, mask=nodata_mask(data, self.nodata))
+
+    def read_masks(self, window=None):
+        """Mask in the read_masks convention: 0 for nodata cells, 255 for valid cells."""
+        return np.where(valid_mask(self.read(window), self.nodata), 255, 0).astype(np.uint8)
+
+
+def init_worker_dataset(path):
+    """Pool initializer: open path once in every worker process, for tasks that read their windows directly."""
+    global _worker_dataset
+    _worker_dataset = rasterio.open(path)
+
+
+def worker_dataset():
+    """The dataset that init_worker_dataset opened in this worker process."""
+    return _worker_dataset
+
+
+def init_worker_reader(path, cache_bytes=DEFAULT_CACHE_BYTES):
+    """Pool initializer: open path once in every worker process, read through a block cache.
+
+    The tasks of a worker then share the open dataset and the cache, so the
+    overlapping windows of neighbouring tasks are not read from disk again.
+    """
+    global _worker_reader
+    _worker_reader = CachedReader(rasterio.open(path), cache=BlockCache(cache_bytes))
+
+
+def worker_reader():
+    """The CachedReader that init_worker_reader opened in this worker process."""
+    return _worker_reader
+
+
+def bounded_map(executor, fn, tasks, max_pending, ordered=False):
+    """Run fn(*args) in executor for every args tuple of tasks and yield the results.
+
+    At most max_pending tasks are submitted and not yet yielded at any time, so
+    results that are not consumed yet do not pile up in memory. tasks may be a
+    generator; the next tuple is taken only when there is room for it. Results
+    are yielded as the tasks finish, or in the order of tasks with ordered=True.
+    """
+    tasks = iter(tasks)
+    pending = deque()
+    while True:
+        for args in tasks:
+            pending.append(executor.submit(fn, *args))
+            if len(pending) >= max_pending:
+                break
+        if not pending:
+            return
+        if ordered:
+            yield pending.popleft().result()
+        else:
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            pending = deque(future for future in pending if future in not_done)
+            for future in done:
+                yield future.result()
@@ -1,52 +1,121 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from osgeo import gdal, osr
 
 gdal.UseExceptions()  # Enable exceptions
 
-def reproject_geotiff(src_path, src_proj, dst_path, dst_proj):
+CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER']
+
+@lru_cache(maxsize=None)
+def spatial_reference_wkt(proj):
+    """WKT of a projection given as 'EPSG:<code>' or WKT, built once per distinct projection."""
+    srs = osr.SpatialReference()
+    if proj.startswith('EPSG:'):
+        srs.ImportFromEPSG(int(proj.split(':')[1]))
+    else:
+        srs.ImportFromWkt(proj)
+    print(f"Projection {srs.GetName()} ({srs.GetAuthorityName(None) or 'custom'}:{srs.GetAuthorityCode(None) or '-'})")
+    return srs.ExportToWkt()
+
+def reproject_geotiff(src_path, src_proj, dst_path, dst_proj, warp_memory_mb=512, num_threads='ALL_CPUS'):
     try:
         # Open the source file
         src_ds = gdal.Open(src_path)
         if src_ds is None:
             print(f"Error: Unable to open {src_path}")
-            return
-
-        # Create spatial reference objects for the source and target projections
-        src_srs = osr.SpatialReference()
-        if src_proj.startswith('EPSG:'):
-            src_srs.ImportFromEPSG(int(src_proj.split(':')[1]))
-        else:
-            src_srs.ImportFromWkt(src_proj)
-        
-        dst_srs = osr.SpatialReference()
-        dst_srs.ImportFromWkt(dst_proj)
-
-        # Print source and destination projection information
-        print("Source projection:")
-        print(src_srs.ExportToPrettyWkt())
-        print("\nDestination projection:")
-        print(dst_srs.ExportToPrettyWkt())
-
-        # Perform the reprojection using gdal.Warp
-        gdal.Warp(dst_path, src_ds, srcSRS=src_srs, dstSRS=dst_srs, resampleAlg=gdal.GRA_Bilinear)
+            return False
+
+        # Spatial references are created once and shared between files
+        src_srs = spatial_reference_wkt(src_proj)
+        dst_srs = spatial_reference_wkt(dst_proj)
+
+        # Perform the reprojection using gdal.Warp, multithreaded and with a warp memory budget
+        options = gdal.WarpOptions(
+            format='GTiff',
+            srcSRS=src_srs,
+            dstSRS=dst_srs,
+            resampleAlg=gdal.GRA_Bilinear,
+            multithread=True,
+            warpMemoryLimit=warp_memory_mb,
+            warpOptions=[f'NUM_THREADS={num_threads}'],
+            creationOptions=CREATION_OPTIONS,
+        )
+        dst_ds = gdal.Warp(dst_path, src_ds, options=options)
+        if dst_ds is None:
+            print(f"Error: Reprojection of {src_path} failed")
+            return False
+        dst_ds = None  # close and flush the output
+        src_ds = None
 
         print(f"Reprojection complete. Output saved to {dst_path}")
+        return True
 
     except Exception as e:
-        print(f"An error occurred: {str(e)}")
+        print(f"An error occurred while reprojecting {src_path}: {str(e)}")
         print("GDAL error messages:")
         for i in range(gdal.GetLastErrorNo()):
             print(gdal.GetLastErrorMsg())
+        return False
+
+def reproject_folder(src_folder, src_proj, dst_folder, dst_proj, workers=4, warp_memory_mb=512, num_threads='ALL_CPUS',
+                     suffix='_model'):
+    """Reproject all GeoTIFFs below src_folder into dst_folder, keeping the subfolder structure.
+
+    Up to workers files are warped at the same time; the warp memory budget
+    applies to each of them. Returns the list of files that failed.
+    """
+    jobs = []
+    for root, _, files in os.walk(src_folder):
+        for name in files:
+            if not name.lower().endswith(('.tif', '.tiff')):
+                continue
+            relative = os.path.relpath(root, src_folder)
+            output_folder = os.path.normpath(os.path.join(dst_folder, relative))
+            os.makedirs(output_folder, exist_ok=True)
+            dst_name = os.path.splitext(name)[0] + suffix + '.tif'
+            jobs.append((os.path.join(root, name), os.path.join(output_folder, dst_name)))
+
+    print(f"Reprojecting {len(jobs)} files from {src_folder} to {dst_folder}")
+
+    # build the spatial references before the workers start
+    spatial_reference_wkt(src_proj)
+    spatial_reference_wkt(dst_proj)
+
+    def process(job):
+        src_path, dst_path = job
+        return reproject_geotiff(src_path, src_proj, dst_path, dst_proj, warp_memory_mb, num_threads)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(process, jobs))
+
+    failed = [src_path for (src_path, _), ok in zip(jobs, results) if not ok]
+    print(f"Finished: {len(jobs) - len(failed)} reprojected, {len(failed)} failed")
+    return failed
+
+def main():
+    # User input
+    src_path = r'c:\SYNC\PROJECTEN\H3140.RWANDA\02.Steps\01a.NewDTMAssessment\ALL 4 WETLANDS.tif'
+    dst_path = r'c:\SYNC\PROJECTEN\H3140.RWANDA\02.Steps\01a.NewDTMAssessment\ALL 4 WETLANDS_model.tif'
+
+    # Set a source folder to reproject all GeoTIFFs in it (and its subfolders) instead of a single file
+    src_folder = None
+    dst_folder = r'c:\SYNC\PROJECTEN\H3140.RWANDA\02.Steps\01a.NewDTMAssessment\reprojected'
+
+    # Destination projection
+    dst_proj = 'PROJCRS["ITRF_2005",BASEGEOGCRS["ITRF2005",DATUM["International Terrestrial Reference Frame 2005",ELLIPSOID["GRS 1980",6378137,298.257222101,LENGTHUNIT["metre",1]],ID["EPSG",6896]],PRIMEM["Greenwich",0,ANGLEUNIT["Degree",0.0174532925199433]]],CONVERSION["unnamed",METHOD["Transverse Mercator",ID["EPSG",9807]],PARAMETER["Latitude of natural origin",0,ANGLEUNIT["Degree",0.0174532925199433],ID["EPSG",8801]],PARAMETER["Longitude of natural origin",30,ANGLEUNIT["Degree",0.0174532925199433],ID["EPSG",8802]],PARAMETER["Scale factor at natural origin",0.9999,SCALEUNIT["unity",1],ID["EPSG",8805]],PARAMETER["False easting",500000,LENGTHUNIT["metre",1],ID["EPSG",8806]],PARAMETER["False northing",5000000,LENGTHUNIT["metre",1],ID["EPSG",8807]]],CS[Cartesian,2],AXIS["(E)",east,ORDER[1],LENGTHUNIT["metre",1,ID["EPSG",9001]]],AXIS["(N)",north,ORDER[2],LENGTHUNIT["metre",1,ID["EPSG",9001]]]]'
 
-# User input
-src_path = r'c:\SYNC\PROJECTEN\H3140.RWANDA\02.Steps\01a.NewDTMAssessment\ALL 4 WETLANDS.tif'
-dst_path = r'c:\SYNC\PROJECTEN\H3140.RWANDA\02.Steps\01a.NewDTMAssessment\ALL 4 WETLANDS_model.tif'
+    # Source projection
+    src_proj = 'EPSG:8998'
 
-# Destination projection
-dst_proj = 'PROJCRS["ITRF_2005",BASEGEOGCRS["ITRF2005",DATUM["International Terrestrial Reference Frame 2005",ELLIPSOID["GRS 1980",6378137,298.257222101,LENGTHUNIT["metre",1]],ID["EPSG",6896]],PRIMEM["Greenwich",0,ANGLEUNIT["Degree",0.0174532925199433]]],CONVERSION["unnamed",METHOD["Transverse Mercator",ID["EPSG",9807]],PARAMETER["Latitude of natural origin",0,ANGLEUNIT["Degree",0.0174532925199433],ID["EPSG",8801]],PARAMETER["Longitude of natural origin",30,ANGLEUNIT["Degree",0.0174532925199433],ID["EPSG",8802]],PARAMETER["Scale factor at natural origin",0.9999,SCALEUNIT["unity",1],ID["EPSG",8805]],PARAMETER["False easting",500000,LENGTHUNIT["metre",1],ID["EPSG",8806]],PARAMETER["False northing",5000000,LENGTHUNIT["metre",1],ID["EPSG",8807]]],CS[Cartesian,2],AXIS["(E)",east,ORDER[1],LENGTHUNIT["metre",1,ID["EPSG",9001]]],AXIS["(N)",north,ORDER[2],LENGTHUNIT["metre",1,ID["EPSG",9001]]]]'
+    # Warp memory per file (MB) and number of files processed at the same time
+    warp_memory_mb = 512
+    workers = 4
 
-# Source projection
-src_proj = 'EPSG:8998'
+    if src_folder:
+        reproject_folder(src_folder, src_proj, dst_folder, dst_proj, workers, warp_memory_mb)
+    else:
+        reproject_geotiff(src_path, src_proj, dst_path, dst_proj, warp_memory_mb)
 
-# Call the function
-reproject_geotiff(src_path, src_proj, dst_path, dst_proj)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import LineString
+
+from excavate_trapezium import excavate_trapezium, excavate_trapezium_parallel, excavate_trapezium_windowed, project_on_channel
+
+
+def make_inputs(tmp_path):
+    # flat 10 m DTM with two channels crossing in the middle
+    elevation_tiff = str(tmp_path / 'dtm.tif')
+    with rasterio.open(elevation_tiff, 'w', driver='GTiff', width=100, height=100, count=1, dtype='float32',
+                       crs='EPSG:28992', transform=from_origin(0, 100, 1, 1), nodata=-9999) as dst:
+        dst.write(np.full((1, 100, 100), 10.0, dtype='float32'))
+
+    channels = gpd.GeoDataFrame({
+        'BEDLEVELUP': [7.0, 8.0], 'BEDLEVELDN': [5.0, 6.0],
+        'BEDWIDTHUP': [4.0, 6.0], 'BEDWIDTHDN': [4.0, 6.0],
+        'SLOPEUP': [2.0, 1.5], 'SLOPEDN': [2.0, 1.5],
+    }, geometry=[LineString([(5, 50), (95, 50)]), LineString([(50, 5), (50, 95)])], crs='EPSG:28992')
+    channel_file = str(tmp_path / 'channels.gpkg')
+    channels.to_file(channel_file)
+    return elevation_tiff, channel_file
+
+
+def read(path):
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+def test_excavation_modes_match(tmp_path):
+    elevation_tiff, channel_file = make_inputs(tmp_path)
+    maxdepth = 3
+
+    excavate_trapezium(elevation_tiff, channel_file, str(tmp_path / 'serial.tif'), maxdepth)
+    excavate_trapezium_windowed(elevation_tiff, channel_file, str(tmp_path / 'windowed.tif'), maxdepth)
+    excavate_trapezium_parallel(elevation_tiff, channel_file, str(tmp_path / 'parallel.tif'), maxdepth, workers=2)
+
+    serial = read(tmp_path / 'serial.tif')
+    np.testing.assert_array_equal(serial, read(tmp_path / 'windowed.tif'))
+    np.testing.assert_array_equal(serial, read(tmp_path / 'parallel.tif'))
+    # maxdepth does not add up where the channels cross
+    assert serial.min() == 10.0 - maxdepth
+
+
+def test_projection_with_segment_tree_matches_all_segments():
+    # wiggly channel with a duplicate vertex, points within 8 m of it
+    s = np.arange(0, 300, 2.0)
+    coords = np.column_stack([s, 20 * np.sin(s / 15)])
+    coords = np.insert(coords, 40, coords[40], axis=0)
+    line = LineString(coords)
+    rng = np.random.default_rng(0)
+    candidates = rng.uniform([-10, -30], [310, 30], size=(20_000, 2))
+    points = candidates[line.distance(gpd.points_from_xy(*candidates.T)) <= 8]
+    xs, ys = points[:, 0].copy(), points[:, 1].copy()
+
+    for expected, actual in zip(project_on_channel(xs, ys, line), project_on_channel(xs, ys, line, max_distance=8)):
+        np.testing.assert_array_equal(actual, expected)
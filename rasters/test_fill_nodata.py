@@ -0,0 +1,38 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from fill_nodata import fill_nodata, fill_nodata_tiled
+
+
+def write_tiff(path, data, nodata):
+    profile = dict(driver='GTiff', width=data.shape[1], height=data.shape[0], count=1, dtype='float32',
+                   nodata=nodata, transform=from_origin(0, data.shape[0], 1, 1))
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+
+
+def filled_pair(tmp_path, data, nodata):
+    src = str(tmp_path / 'src.tif')
+    write_tiff(src, data, nodata)
+    fill_nodata(src, str(tmp_path / 'untiled.tif'))
+    fill_nodata_tiled(src, str(tmp_path / 'tiled.tif'), tilesize=64, workers=2)
+    with rasterio.open(tmp_path / 'untiled.tif') as a, rasterio.open(tmp_path / 'tiled.tif') as b:
+        return a.read(1), b.read(1)
+
+
+def test_tiled_fill_matches_untiled_fill(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.random((150, 200)).astype('float32')
+    data[rng.random(data.shape) < 0.3] = -9999
+    data[40:70, 60:100] = -9999
+    untiled, tiled = filled_pair(tmp_path, data, -9999)
+    np.testing.assert_array_equal(tiled, untiled)
+
+
+def test_tiled_fill_uses_dataset_mask(tmp_path):
+    # without a nodata value GDAL treats NaN cells as valid, in the untiled and the tiled fill alike
+    data = np.ones((150, 200), dtype='float32')
+    data[60:70, 90:100] = np.nan
+    untiled, tiled = filled_pair(tmp_path, data, None)
+    assert np.isnan(untiled).sum() == np.isnan(tiled).sum() == 100
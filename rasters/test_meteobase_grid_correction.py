@@ -0,0 +1,50 @@
+import numpy as np
+from scipy.interpolate import griddata
+
+from meteobase_grid_correction import StationInterpolator
+
+STATION_X = [0, 10, 0, 10, 5, 2]
+STATION_Y = [0, 0, 10, 10, 5, 8]
+GRID_X, GRID_Y = np.meshgrid(np.arange(1, 10, 2.0), np.arange(1, 10, 2.0))
+
+
+def test_cubic_weights_match_griddata():
+    interpolator = StationInterpolator(STATION_X, STATION_Y, GRID_X, GRID_Y)
+    values = np.array([1.0, 2, 3, 4, 5, 6])
+    expected = griddata(np.column_stack([STATION_X, STATION_Y]), values, (GRID_X, GRID_Y), method='cubic')
+    np.testing.assert_allclose(interpolator(values), expected, atol=1e-5)
+
+
+def test_missing_station_is_left_out():
+    interpolator = StationInterpolator(STATION_X, STATION_Y, GRID_X, GRID_Y, subset_min_days=3)
+    without_centre = StationInterpolator(STATION_X[:4] + STATION_X[5:], STATION_Y[:4] + STATION_Y[5:], GRID_X, GRID_Y)
+
+    values = np.array([[1, 2, 3, 4, 5, 6], [1, 2, 3, 4, np.nan, 6], [2, 2, 2, 2, np.nan, 2]])
+    expected = without_centre(values[1:, [0, 1, 2, 3, 5]])
+    interpolated = interpolator(values)
+    np.testing.assert_allclose(interpolated[0], interpolator(values[0]), atol=1e-5)
+    # a rare pattern is interpolated with griddata, no weights are kept for it
+    np.testing.assert_allclose(interpolated[1:], expected, atol=1e-5)
+    assert interpolator.subsets.nbytes == 0
+
+    # from the third day with this pattern on, its weights are cached
+    np.testing.assert_allclose(interpolator(values[1]), expected[0], atol=1e-5)
+    assert interpolator.subsets.nbytes > 0
+    np.testing.assert_allclose(interpolator(values[2]), expected[1], atol=1e-5)
+    assert interpolator.subsets.hits == 1
+
+
+def test_subset_cache_is_limited():
+    interpolator = StationInterpolator(STATION_X, STATION_Y, GRID_X, GRID_Y, subset_min_days=1,
+                                       subset_cache_bytes=2000)
+    for missing in range(6):
+        values = np.arange(6.0)
+        values[missing] = np.nan
+        interpolator(values)
+    assert interpolator.subsets.nbytes <= interpolator.subsets.max_bytes
+
+
+def test_too_few_stations_gives_nan():
+    grid_x, grid_y = np.meshgrid([2.0, 4.0], [2.0, 4.0])
+    interpolator = StationInterpolator([0, 10, 0], [0, 0, 10], grid_x, grid_y, method='linear')
+    assert np.isnan(interpolator([1, np.nan, 3])).all()
@@ -0,0 +1,58 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from raster_io import CachedReader, aligned_size, block_windows, bounded_map
+
+
+def test_aligned_size_tiled():
+    assert aligned_size((256, 256), 10_000, 10_000, 1000) == (1024, 1024)
+    assert aligned_size((256, 256), 500, 300, 1000) == (300, 500)
+
+
+def test_aligned_size_strips_keep_square_windows():
+    # ASCII grids have one-row blocks the full width of the grid
+    assert aligned_size((1, 100_000), 100_000, 50_000, 1024) == (1024, 1024)
+    assert aligned_size((1, 800), 800, 5000, 1024) == (1024, 800)
+
+
+def test_block_windows_cover_strip_raster():
+    windows = list(block_windows(2500, 1500, (1, 2500), 1024))
+    assert max(window.width for window in windows) == 1024
+    assert sum(window.width * window.height for window in windows) == 2500 * 1500
+
+
+def test_cached_reader_on_ascii_grid(tmp_path):
+    path = str(tmp_path / 'grid.asc')
+    data = np.arange(60 * 3000, dtype='float32').reshape(60, 3000)
+    with rasterio.open(path, 'w', driver='AAIGrid', width=3000, height=60, count=1, dtype='float32',
+                       transform=from_origin(0, 60, 1, 1)) as dst:
+        dst.write(data, 1)
+    with rasterio.open(path) as src:
+        reader = CachedReader(src, block_size=1024)
+        assert reader.block_cols == 1024
+        window = rasterio.windows.Window(1000, 10, 100, 20)
+        np.testing.assert_array_equal(reader.read(window), data[10:30, 1000:1100])
+
+
+def test_bounded_map_limits_tasks_in_flight():
+    lock = threading.Lock()
+    running = [0, 0]  # current, maximum
+
+    def task(i):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01 * (i % 3))
+        with lock:
+            running[0] -= 1
+        return i
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert sorted(bounded_map(executor, task, ((i,) for i in range(20)), 3)) == list(range(20))
+        assert list(bounded_map(executor, task, ((i,) for i in range(20)), 3, ordered=True)) == list(range(20))
+    assert running[1] <= 3
@@ -1,34 +1,170 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import rasterio
 import geopandas as gpd
 import numpy as np
-from rasterio.mask import mask
-from shapely.geometry import mapping
+import pandas as pd
 from rasterio.crs import CRS
+from rasterio.features import rasterize
+from shapely.geometry import box
 
-def read_asc_grid(filepath, crs):
-    with rasterio.open(filepath) as src:
-        data = src.read(1)
-        transform = src.transform
-        nodata = src.nodata
-        src_crs = crs  # Set the CRS directly to EPSG:28992
-    return data, transform, nodata, src_crs, filepath
+from raster_io import DEFAULT_WINDOW_SIZE, dataset_windows, nodata_mask
+
+
+def empty_statistics(n):
+    # index 0 collects the cells outside all polygons
+    return {
+        'volume': np.zeros(n + 1),
+        'cells': np.zeros(n + 1, dtype=np.int64),
+        'nodata_cells': np.zeros(n + 1, dtype=np.int64),
+        'min_diff': np.full(n + 1, np.inf),
+        'max_diff': np.full(n + 1, -np.inf),
+    }
+
+
+def accumulate_statistics(stats, labels, data1, data2, invalid):
+    """Add the cells of one window to the per-label statistics."""
+    n = len(stats['volume'])
+    inside = labels > 0
+    labels_invalid = labels[inside & invalid]
+    valid = inside & ~invalid
+    labels_valid = labels[valid]
+    diff = data2[valid].astype(np.float64) - data1[valid]
+
+    stats['volume'] += np.bincount(labels_valid, weights=diff, minlength=n)
+    stats['cells'] += np.bincount(labels_valid, minlength=n)
+    stats['nodata_cells'] += np.bincount(labels_invalid, minlength=n)
+    np.minimum.at(stats['min_diff'], labels_valid, diff)
+    np.maximum.at(stats['max_diff'], labels_valid, diff)
+
+
+def statistics_frame(stats, cell_area):
+    cells = stats['cells'][1:]
+    empty = cells == 0
+    return pd.DataFrame({
+        'volume': stats['volume'][1:] * cell_area,
+        'cells': cells,
+        'area': cells * cell_area,
+        'nodata_area': stats['nodata_cells'][1:] * cell_area,
+        'min_diff': np.where(empty, np.nan, stats['min_diff'][1:]),
+        'max_diff': np.where(empty, np.nan, stats['max_diff'][1:]),
+    })
+
+
+def polygon_labels(polygons, window, transform):
+    """Label grid of a window: 0 outside the polygons, i + 1 inside polygon i."""
+    labels = np.zeros((window.height, window.width), dtype=np.int32)
+    # only rasterize the polygons that overlap this window
+    candidates = polygons.sindex.query(box(*rasterio.windows.bounds(window, transform)))
+    if len(candidates):
+        rasterize(
+            ((polygons.iloc[i], i + 1) for i in np.sort(candidates)),
+            out=labels, transform=rasterio.windows.transform(window, transform))
+    return labels
+
+
+def zonal_volume_difference(grid1_path, grid2_path, polygons, window_size=DEFAULT_WINDOW_SIZE):
+    """Per-polygon volume difference (grid2 - grid1) in a single pass over both grids.
+
+    The grids are read window by window, aligned to their internal tiling. In each window the polygons that
+    overlap it are rasterized into a label grid, and all statistics are
+    aggregated per label with np.bincount-style reductions. Where polygons
+    overlap, a cell counts for the polygon that comes last.
+
+    Returns a DataFrame with one row per polygon (in the order of polygons):
+    the volume difference, the number of valid cells, the valid area, the
+    area excluded because of nodata and the min/max difference.
+    """
+    polygons = gpd.GeoSeries(polygons).reset_index(drop=True)
+    stats = empty_statistics(len(polygons))
 
-def calculate_volume_difference(grid1_path, grid2_path, transform, nodata1, nodata2, polygon):
     with rasterio.open(grid1_path) as src1, rasterio.open(grid2_path) as src2:
-        # Mask the grids with the polygon
-        out_image1, _ = mask(src1, [mapping(polygon)], crop=True)
-        out_image2, _ = mask(src2, [mapping(polygon)], crop=True)
-    
-    # Identify nodata cells
-    nodata_mask = (out_image1 == nodata1) | (out_image2 == nodata2)
-    
-    # Calculate the cell size (area of one cell)
-    cell_size = transform[0] * abs(transform[4])  # pixel width * pixel height
-    
-    # Calculate the volume difference, ignoring nodata cells
-    valid_diff = np.where(nodata_mask, 0, out_image2 - out_image1)
-    volume_difference = valid_diff.sum() * cell_size
-    return volume_difference
+        if src1.transform != src2.transform or src1.shape != src2.shape:
+            raise ValueError("The two grids must have the same transform properties")
+
+        for window in dataset_windows(src1, window_size):
+            labels = polygon_labels(polygons, window, src1.transform)
+            if not labels.any():
+                continue
+            data1 = src1.read(1, window=window)
+            data2 = src2.read(1, window=window)
+            invalid = nodata_mask(data1, src1.nodata) | nodata_mask(data2, src2.nodata)
+            accumulate_statistics(stats, labels, data1, data2, invalid)
+
+        cell_area = abs(src1.transform.a * src1.transform.e)  # pixel width * pixel height
+    return statistics_frame(stats, cell_area)
+
+
+def prepare_baseline(baseline_path, polygons, workdir, window_size=DEFAULT_WINDOW_SIZE):
+    """Read the baseline grid and rasterize the polygon labels once.
+
+    Both are stored as memory-mappable .npy files in workdir (nodata as NaN in
+    the baseline), so the scenario workers can share them without reparsing.
+    """
+    with rasterio.open(baseline_path) as src:
+        dtype = np.result_type(src.dtypes[0], np.float32)
+        baseline = np.lib.format.open_memmap(os.path.join(workdir, 'baseline.npy'), mode='w+', dtype=dtype, shape=src.shape)
+        labels = np.lib.format.open_memmap(os.path.join(workdir, 'labels.npy'), mode='w+', dtype=np.int32, shape=src.shape)
+        for window in dataset_windows(src, window_size):
+            cells = window.toslices()
+            data = src.read(1, window=window).astype(dtype)
+            data[nodata_mask(data, src.nodata)] = np.nan
+            baseline[cells] = data
+            labels[cells] = polygon_labels(polygons, window, src.transform)
+        baseline.flush()
+        labels.flush()
+        del baseline, labels
+        return src.transform, src.shape
+
+
+def scenario_statistics(workdir, scenario_path, n_polygons, transform, shape, window_size=DEFAULT_WINDOW_SIZE):
+    """Statistics of one scenario against the prepared baseline (runs in a worker process)."""
+    baseline = np.load(os.path.join(workdir, 'baseline.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(workdir, 'labels.npy'), mmap_mode='r')
+    stats = empty_statistics(n_polygons)
+
+    with rasterio.open(scenario_path) as src:
+        if src.transform != transform or src.shape != shape:
+            raise ValueError(f"{scenario_path} must have the same transform properties as the baseline grid")
+        for window in dataset_windows(src, window_size):
+            cells = window.toslices()
+            window_labels = np.asarray(labels[cells])
+            if not window_labels.any():
+                continue
+            data1 = np.asarray(baseline[cells])
+            data2 = src.read(1, window=window)
+            invalid = np.isnan(data1) | nodata_mask(data2, src.nodata)
+            accumulate_statistics(stats, window_labels, data1, data2, invalid)
+
+    del baseline, labels
+    return statistics_frame(stats, abs(transform.a * transform.e))
+
+
+def batch_volume_difference(baseline_path, scenario_paths, polygons, workers=None, window_size=DEFAULT_WINDOW_SIZE):
+    """Per-polygon statistics of several scenario grids against one baseline grid.
+
+    scenario_paths maps a scenario name to its grid. The baseline and the
+    polygon labels are prepared once, the scenarios are evaluated in parallel
+    worker processes. Returns a dict of scenario name -> DataFrame as returned
+    by zonal_volume_difference.
+    """
+    polygons = gpd.GeoSeries(polygons).reset_index(drop=True)
+    workers = workers or min(len(scenario_paths), os.cpu_count())
+
+    with tempfile.TemporaryDirectory() as workdir:
+        transform, shape = prepare_baseline(baseline_path, polygons, workdir, window_size)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                name: executor.submit(scenario_statistics, workdir, path, len(polygons), transform, shape, window_size)
+                for name, path in scenario_paths.items()
+            }
+            results = {}
+            for name, future in futures.items():
+                results[name] = future.result()
+                print(f"Finished scenario {name}")
+    return results
+
 
 def main():
     # EPSG code for the projection
@@ -36,43 +172,35 @@ def main():
     crs = CRS.from_epsg(epsg_code)
 
     # File paths
-    grid1_path = r"c:\SYNC\PROJECTEN\H1298.CorioGlanaHL1617\09.Bergingsvarianten2\BUI2 aanp 2Dgrid2, CG HL16_17, T100 geactualiseerd ONTW+2 ty10 v2 latQt\dm1maxh0.asc"
-    #grid2_path = r"c:\SYNC\PROJECTEN\H1298.CorioGlanaHL1617\09.Bergingsvarianten2\BUI2 aanp 2Dgrid2, CG HL16_17, T100 geactualiseerd ONTW+2 ty10 v2 VarAa@38 latQt\dm1maxh0.asc"
-    #grid2_path = r"c:\SYNC\PROJECTEN\H1298.CorioGlanaHL1617\09.Bergingsvarianten2\BUI2 aanp 2Dgrid2, CG HL16_17, T100 geactualiseerd ONTW+2 ty10 v2 VarAa@40 latQt\dm1maxh0.asc"
-    grid2_path = r"c:\SYNC\PROJECTEN\H1298.CorioGlanaHL1617\09.Bergingsvarianten2\BUI2 aanp 2Dgrid2, CG HL16_17, T100 geactualiseerd ONTW+2 ty10 v2 VarAa@35 latQt\dm1maxh0.asc"
+    baseline_path = r"c:\SYNC\PROJECTEN\H1298.CorioGlanaHL1617\09.Bergingsvarianten2\BUI2 aanp 2Dgrid2, CG HL16_17, T100 geactualiseerd ONTW+2 ty10 v2 latQt\dm1maxh0.asc"
     shapefile_path = r"c:\SYNC\PROJECTEN\H1298.CorioGlanaHL1617\09.Bergingsvarianten2\MaxBerging.shp"
 
-    # Read the ASC grids
-    grid1, transform1, nodata1, crs1, grid1_filepath = read_asc_grid(grid1_path, crs)
-    grid2, transform2, nodata2, crs2, grid2_filepath = read_asc_grid(grid2_path, crs)
-    
-    if transform1 != transform2:
-        raise ValueError("The two grids must have the same transform properties")
-    
-    if crs1 != crs2:
-        raise ValueError("The two grids must have the same CRS")
+    # Scenario grids to compare against the baseline; the key becomes the column name in the shapefile
+    scenario_paths = {
+        'Aa38': r"c:\SYNC\PROJECTEN\H1298.CorioGlanaHL1617\09.Bergingsvarianten2\BUI2 aanp 2Dgrid2, CG HL16_17, T100 geactualiseerd ONTW+2 ty10 v2 VarAa@38 latQt\dm1maxh0.asc",
+        'Aa40': r"c:\SYNC\PROJECTEN\H1298.CorioGlanaHL1617\09.Bergingsvarianten2\BUI2 aanp 2Dgrid2, CG HL16_17, T100 geactualiseerd ONTW+2 ty10 v2 VarAa@40 latQt\dm1maxh0.asc",
+        'Aa35': r"c:\SYNC\PROJECTEN\H1298.CorioGlanaHL1617\09.Bergingsvarianten2\BUI2 aanp 2Dgrid2, CG HL16_17, T100 geactualiseerd ONTW+2 ty10 v2 VarAa@35 latQt\dm1maxh0.asc",
+    }
 
     # Read the shapefile
     gdf = gpd.read_file(shapefile_path)
-    
-    # Ensure the shapefile CRS matches the desired CRS
+
+    # Ensure the shapefile CRS matches the CRS of the grids (ASC grids carry no CRS of their own)
     if gdf.crs != crs:
         gdf = gdf.to_crs(crs)
 
-    # Calculate volume differences for each polygon
-    volume_differences = []
-    for polygon in gdf.geometry:
-        volume_diff = calculate_volume_difference(grid1_filepath, grid2_filepath, transform1, nodata1, nodata2, polygon)
-        volume_differences.append(volume_diff)
-    
-    # Add the volume differences to a new column in the GeoDataFrame
-    gdf['Aa35'] = volume_differences
-    
+    # Calculate the volume differences of all scenarios, the baseline is read only once
+    results = batch_volume_difference(baseline_path, scenario_paths, gdf.geometry)
+
+    # Add the volume differences of each scenario to its own column in the GeoDataFrame
+    for name, stats in results.items():
+        gdf[name] = stats['volume'].values
+
     # Save the updated shapefile to a new file first to verify changes
     #new_shapefile_path = shapefile_path.replace(".shp", "_updated.shp")
     # just update the existing shapefile
     gdf.to_file(shapefile_path)
-    
+
     # After verifying the new file, you can overwrite the original file if needed
     # gdf.to_file(shapefile_path)
 